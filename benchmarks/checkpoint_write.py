@@ -0,0 +1,52 @@
+"""
+Measure the write throughput of a checkpoint.
+
+Rows shaped like corpus rows are written to a checkpoint file in a temporary directory and flushed every
+CHECKPOINT-FREQUENCY rows. The number of rows written per second is reported for each row count.
+
+    python benchmarks/checkpoint_write.py --rows 1000 10000 100000 1000000
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from themis import ANSWER_ID, ANSWER, TITLE, FILENAME, DOCUMENT_ID
+from themis.checkpoint import DataFrameCheckpoint
+
+COLUMNS = [ANSWER_ID, ANSWER, TITLE, FILENAME, DOCUMENT_ID]
+
+
+def write_rows(filename, rows, checkpoint_frequency):
+    checkpoint = DataFrameCheckpoint(filename, COLUMNS, checkpoint_frequency)
+    start = time.time()
+    for i in range(rows):
+        checkpoint.write("pau-%d" % i, "<p>Answer text for PAU %d, with a comma.</p>" % i, "Title %d" % i,
+                         "document-%d.pdf" % (i // 10), str(i // 10))
+    checkpoint.close()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", metavar="ROWS", type=int, nargs="+", default=[10 ** n for n in range(3, 7)],
+                        help="numbers of rows to write")
+    parser.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=1000,
+                        help="flush to the checkpoint file after writing this many rows")
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        print("Rows\tSeconds\tRows/sec")
+        for rows in args.rows:
+            filename = os.path.join(directory, "checkpoint.%d.csv" % rows)
+            seconds = write_rows(filename, rows, args.checkpoint_frequency)
+            print("%d\t%0.3f\t%0.0f" % (rows, seconds, rows / seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
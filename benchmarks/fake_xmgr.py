@@ -0,0 +1,222 @@
+"""
+A local stand-in for an XMGR project, for exercising and benchmarking the XMGR download code without a real XMGR
+instance.
+
+The server serves a synthetic corpus of DOCUMENTS documents, each containing PAUS PAUs whose answer text is about
+PAU-SIZE characters long, and QUESTIONS questions, some of which are rejected, some of which are mapped to other
+questions, and some of which are mapped to PAUs that are not in any document. Every request is delayed by LATENCY
+seconds, and a fraction ERROR-RATE of requests fail with HTTP status 503. Responses are gzipped if the client accepts it
+and carry an ETag.
+
+It can be run on its own and pointed at by the themis command line,
+
+    python benchmarks/fake_xmgr.py --port 8080 --documents 1000 --latency 0.05
+    themis xmgr download-corpus http://localhost:8080/ username password
+
+or started from another script with FakeXmgr.
+"""
+from __future__ import print_function
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+PARAGRAPH = "Answer text with <b>markup</b>, punctuation &amp; entities. "
+
+
+class FakeXmgr(object):
+    """
+    Synthetic XMGR project served over HTTP on a background thread
+
+    Use it as a context manager, or call start and stop. The project URL is in the url attribute once it has started.
+
+    Documents are numbered from 0. Document d contains the PAUs d-0, d-1, ... Questions are numbered q0, q1, ... The
+    data is generated from a seed, so the same arguments always produce the same project.
+    """
+
+    def __init__(self, documents=100, paus=5, pau_size=1000, questions=1000, latency=0.0, error_rate=0.0, port=0,
+                 seed=0):
+        self.documents = documents
+        self.paus = paus
+        self.pau_size = pau_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.port = port
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Documents whose PAU lists cannot be found, and the version of each document that has been modified.
+        self.missing = set()
+        self.versions = {}
+        self.requests = 0
+        self.errors = 0
+        self.questions = [self.question(i, questions) for i in range(questions)]
+        self.server = None
+        self.url = None
+
+    def __repr__(self):
+        return "Fake XMGR %s: %d documents, %d PAUs each, %d questions" % \
+               (self.url, self.documents, self.paus, len(self.questions))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.server = ThreadingServer(("127.0.0.1", self.port), FakeXmgrHandler)
+        self.server.xmgr = self
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def modify(self, document_id):
+        """
+        Change the text of a document's PAUs and its modification time.
+        """
+        self.versions[document_id] = self.versions.get(document_id, 0) + 1
+
+    def question(self, i, n):
+        r = self.random
+        question = {"id": "q%d" % i, "text": "Question %d?" % i,
+                    "state": "REJECTED" if r.random() < 0.05 else "APPROVED", "lastModifiedDate": 1500000000000 + i}
+        x = r.random()
+        if x < 0.2 and i > 0:
+            question["mappedQuestion"] = {"id": "q%d" % r.randrange(i)}
+        elif x < 0.25 or not self.documents or not self.paus:
+            # A PAU that is not in any document, as the 'xmgr augment-truth' command looks for.
+            question["predefinedAnswerUnit"] = "extra-%d" % r.randrange(n)
+        elif x < 0.95:
+            question["predefinedAnswerUnit"] = "%d-%d" % (r.randrange(self.documents), r.randrange(self.paus))
+        return question
+
+    def response(self, path, params):
+        """
+        :return: the JSON response to a request, or None if the path is not found
+        :rtype: object
+        """
+        if path.endswith("/workbench/api/questions"):
+            offset, pagesize = int(params["offset"][0]), int(params["pagesize"][0])
+            return {"total": len(self.questions), "items": self.questions[offset:offset + pagesize]}
+        if path.endswith("/xmgr/corpus/document"):
+            return [{"id": d, "title": "Document %d" % d, "lastModified": 1500000000000 + self.versions.get(d, 0)}
+                    for d in range(self.documents)]
+        if path.endswith("/xmgr/corpus/wea/trec"):
+            d = int(params["srcDocId"][0])
+            if d in self.missing or not 0 <= d < self.documents:
+                return None
+            return {"items": [{"DOCNO": "%d-%d" % (d, j)} for j in range(self.paus)]}
+        if "/wcea/api/GroundTruth/paus/" in path:
+            pau_id = path.rsplit("/", 1)[1]
+            version = self.versions.get(int(pau_id.split("-")[0]), 0) if not pau_id.startswith("extra") else 0
+            text = "<p>PAU %s version %d. %s</p>" % (pau_id, version, PARAGRAPH * (self.pau_size // len(PARAGRAPH)))
+            return {"hits": [{"id": pau_id, "responseMarkup": text, "title": "Title of %s" % pau_id,
+                              "sourceName": "document-%s.pdf" % pau_id.split("-")[0]}]}
+        return None
+
+    def fail(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return failed
+
+
+class FakeXmgrHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which would stall on delayed ACKs on a keep-alive connection.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        xmgr = self.server.xmgr
+        if xmgr.latency:
+            time.sleep(xmgr.latency)
+        if xmgr.fail():
+            self.send(503, b"Service unavailable")
+            return
+        url = urlparse(self.path)
+        response = xmgr.response(url.path, parse_qs(url.query))
+        if response is None:
+            self.send(404, b"The page you were looking for could not be found.")
+            return
+        body = json.dumps(response).encode("utf-8")
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send(304, b"", {"ETag": etag})
+            return
+        headers = {"Content-Type": "application/json", "ETag": etag}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            buffer = io.BytesIO()
+            with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=1) as f:
+                f.write(body)
+            body = buffer.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        self.send(200, body, headers)
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def server_arguments(parser):
+    """
+    Add options describing a fake XMGR project to an argument parser.
+    """
+    parser.add_argument("--documents", metavar="DOCUMENTS", type=int, default=100, help="number of documents")
+    parser.add_argument("--paus", metavar="PAUS", type=int, default=5, help="number of PAUs in each document")
+    parser.add_argument("--pau-size", metavar="PAU-SIZE", type=int, default=1000,
+                        help="approximate number of characters of answer text in each PAU")
+    parser.add_argument("--questions", metavar="QUESTIONS", type=int, default=1000, help="number of questions")
+    parser.add_argument("--latency", metavar="SECONDS", type=float, default=0.0, help="delay before every response")
+    parser.add_argument("--error-rate", metavar="FRACTION", type=float, default=0.0,
+                        help="fraction of requests that fail with HTTP status 503")
+    parser.add_argument("--seed", metavar="SEED", type=int, default=0, help="random number seed")
+
+
+def fake_xmgr(args, port=0):
+    return FakeXmgr(args.documents, args.paus, args.pau_size, args.questions, args.latency, args.error_rate, port,
+                    args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", metavar="PORT", type=int, default=8080, help="port to listen on")
+    server_arguments(parser)
+    args = parser.parse_args()
+    xmgr = fake_xmgr(args, args.port)
+    xmgr.start()
+    print(xmgr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        xmgr.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measure how fast TREC files are parsed.
+
+A directory of FILES synthetic TREC files, each with an answer of about ANSWER-SIZE characters of escaped HTML, is
+created in a temporary directory. Every file is parsed first by parse_trec_file, which scans the file for the corpus
+fields and only falls back to Beautiful Soup when it has to, then by soup_trec_file, which always uses Beautiful Soup.
+The number of files parsed per second is reported for each, after checking that they extract the same fields.
+
+With the --processes option the files are then parsed into a checkpoint by pools of each number of processes, as
+'xmgr trec-corpus --processes' does, first sending the files to the processes one at a time and then in chunks. The
+number of files parsed per second is reported for each.
+
+    python benchmarks/trec_parse.py --files 1000 --answer-size 2000 --processes 1 4
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from themis import logger
+from themis.checkpoint import get_items
+from themis.trec import TrecFileCheckpoint, parse_trec_file, parse_trec_files, soup_trec_file
+
+TREC = """<DOC>
+<DOCNO>%(id)s</DOCNO>
+<title>Title of answer %(id)s &amp; more</title>
+<text>%(text)s</text>
+<meta:key:pautid>%(id)s</meta:key:pautid>
+<meta:key:originalfile>document-%(document)d.pdf</meta:key:originalfile>
+<meta:documentid>%(document)d</meta:documentid>
+</DOC>
+"""
+
+PARAGRAPH = "&lt;p&gt;Answer text with &lt;b&gt;markup&lt;/b&gt;, punctuation &amp;amp; entities.&lt;/p&gt;\n"
+
+
+def write_trec_files(directory, files, answer_size):
+    text = PARAGRAPH * max(answer_size // len(PARAGRAPH), 1)
+    for i in range(files):
+        with open(os.path.join(directory, "%06d.xml" % i), "w") as f:
+            f.write(TREC % {"id": "pau-%d" % i, "text": text, "document": i // 10})
+
+
+def files_per_second(parse, filenames):
+    start = time.time()
+    fields = [parse(filename) for filename in filenames]
+    return len(filenames) / (time.time() - start), fields
+
+
+def pooled_files_per_second(directory, filenames, processes, chunked):
+    checkpoint_filename = os.path.join(directory, "checkpoint.csv")
+    start = time.time()
+    if chunked:
+        parse_trec_files(checkpoint_filename, directory, 1000, None, processes)
+    else:
+        get_items("TREC files", filenames, TrecFileCheckpoint(checkpoint_filename, 1000), parse_trec_file, 1000,
+                  processes, processes=True)
+    seconds = time.time() - start
+    os.remove(checkpoint_filename)
+    return len(filenames) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", metavar="FILES", type=int, default=1000, help="number of TREC files")
+    parser.add_argument("--answer-size", metavar="ANSWER-SIZE", type=int, default=2000,
+                        help="approximate number of characters in each answer")
+    parser.add_argument("--processes", metavar="PROCESSES", type=int, nargs="*", default=[],
+                        help="numbers of processes to parse the files into a checkpoint with")
+    args = parser.parse_args()
+    logger.setLevel(logging.ERROR)
+    directory = tempfile.mkdtemp()
+    try:
+        write_trec_files(directory, args.files, args.answer_size)
+        filenames = sorted(glob.glob(os.path.join(directory, "*.xml")))
+        scanned, scanned_fields = files_per_second(parse_trec_file, filenames)
+        parsed, parsed_fields = files_per_second(soup_trec_file, filenames)
+        assert scanned_fields == parsed_fields, "parse_trec_file and soup_trec_file extracted different fields"
+        print("Scan\tBeautiful Soup")
+        print("%0.0f\t%0.0f" % (scanned, parsed))
+        if args.processes:
+            print("Processes\tOne at a time\tChunked")
+            for processes in args.processes:
+                print("%d\t%0.0f\t%0.0f" % (processes,
+                                             pooled_files_per_second(directory, filenames, processes, False),
+                                             pooled_files_per_second(directory, filenames, processes, True)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Measure the end-to-end throughput of downloads from XMGR against a local fake XMGR project.
+
+Each scenario runs in a new temporary directory against the project served by fake_xmgr.FakeXmgr.
+
+    corpus      download the corpus with 'xmgr download-corpus'
+    journal     download the corpus with 'xmgr download-corpus --journal'
+    restart     download the corpus with the PAU lists of the last half of the documents missing, so that the download
+                fails, then download it again once they are back, timing only the second run
+    sync        download the corpus, modify a tenth of the documents, then time 'xmgr download-corpus --sync'
+    truth       download the truth with 'xmgr truth'
+    augment     add the PAUs in the truth that are not in the corpus with 'xmgr augment-truth'
+
+The number of seconds each scenario took and the number of items it processed per second are reported. With the
+--memory option each scenario is run a second time with tracemalloc to report the peak memory it allocated.
+
+    python benchmarks/xmgr_download.py --documents 1000 --latency 0.01 --workers 8 --pau-workers 4
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from fake_xmgr import server_arguments, fake_xmgr
+from themis import logger
+from themis.throttle import RetryPolicy, CircuitBreaker
+from themis.xmgr import XmgrProject, CorpusFileType, TruthFileType, download_corpus_from_xmgr, \
+    download_truth_from_xmgr, augment_corpus_truth
+
+SCENARIOS = ["corpus", "journal", "restart", "sync", "truth", "augment"]
+
+
+# Each scenario is a generator that does its setup, yields, does the work to be measured, and yields the number of items
+# it processed.
+def corpus(server, xmgr, directory, args):
+    yield
+    yield download_corpus(server, xmgr, directory, args)
+
+
+def journal(server, xmgr, directory, args):
+    yield
+    yield download_corpus(server, xmgr, directory, args, journal=True)
+
+
+def restart(server, xmgr, directory, args):
+    server.missing = set(range(server.documents // 2, server.documents))
+    try:
+        download_corpus(server, xmgr, directory, args)
+    except Exception:
+        pass
+    finally:
+        server.missing = set()
+    yield
+    download_corpus(server, xmgr, directory, args)
+    yield (server.documents - server.documents // 2) * server.paus
+
+
+def sync(server, xmgr, directory, args):
+    download_corpus(server, xmgr, directory, args)
+    modified = range(0, server.documents, 10)
+    for document_id in modified:
+        server.modify(document_id)
+    yield
+    download_corpus_from_xmgr(xmgr, directory, args.checkpoint_frequency, None, False, None, args.workers,
+                              args.pau_workers, sync=True)
+    yield len(modified) * server.paus
+
+
+def truth(server, xmgr, directory, args):
+    yield
+    download_truth_from_xmgr(xmgr, directory, args.workers)
+    yield len(server.questions)
+
+
+def augment(server, xmgr, directory, args):
+    download_corpus(server, xmgr, directory, args)
+    download_truth_from_xmgr(xmgr, directory, args.workers)
+    corpus_csv = CorpusFileType()(os.path.join(directory, "corpus.csv"))
+    truth_csv = TruthFileType()(os.path.join(directory, "truth.csv"))
+    n = len(corpus_csv)
+    yield
+    augmented = augment_corpus_truth(xmgr, corpus_csv, truth_csv, args.checkpoint_frequency, args.workers, directory)
+    yield len(augmented) - n
+
+
+def download_corpus(server, xmgr, directory, args, journal=False):
+    download_corpus_from_xmgr(xmgr, directory, args.checkpoint_frequency, None, journal, None, args.workers,
+                              args.pau_workers)
+    return server.documents * server.paus
+
+
+def run(scenario, args, memory=False):
+    """
+    Run a scenario against a new fake XMGR project.
+
+    :return: seconds taken, number of items and peak memory allocated in bytes, or None if memory was not traced
+    :rtype: (float, int, int)
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        with fake_xmgr(args) as server:
+            xmgr = XmgrProject(server.url, "username", "password",
+                               RetryPolicy(args.attempts, 0.01, 0.1, CircuitBreaker(cool_down=0.1)),
+                               max(10, (args.workers or 1) * (args.pau_workers or 1)))
+            steps = globals()[scenario](server, xmgr, directory, args)
+            next(steps)
+            if memory:
+                tracemalloc.start()
+            start = time.time()
+            items = next(steps)
+            seconds = time.time() - start
+            peak = None
+            if memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            return seconds, items, peak
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    server_arguments(parser)
+    parser.add_argument("--scenarios", metavar="SCENARIO", nargs="+", choices=SCENARIOS, default=SCENARIOS,
+                        help="scenarios to run: %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--workers", metavar="WORKERS", type=int, help="number of documents to download at once")
+    parser.add_argument("--pau-workers", metavar="PAU-WORKERS", type=int,
+                        help="number of PAUs in each document to download at once")
+    parser.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=10,
+                        help="flush to the checkpoint files after downloading this many items")
+    parser.add_argument("--attempts", metavar="ATTEMPTS", type=int, default=5,
+                        help="number of times to attempt each request")
+    parser.add_argument("--memory", action="store_true", help="also report peak memory allocated by each scenario")
+    args = parser.parse_args()
+    logger.setLevel(logging.ERROR)
+    print("Scenario\tSeconds\tItems/s%s" % ("\tPeak MB" if args.memory else ""))
+    for scenario in args.scenarios:
+        seconds, items, _ = run(scenario, args)
+        line = "%s\t%0.2f\t%0.1f" % (scenario, seconds, items / max(seconds, 1e-9))
+        if args.memory:
+            line += "\t%0.1f" % (run(scenario, args, memory=True)[2] / 1024.0 / 1024)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Measure the request throughput of XmgrProject against a local stand-in for XMGR.
+
+The stand-in server, fake_xmgr.FakeXmgr, answers every PAU request with a small JSON document, gzipped if the client
+accepts it, over keep-alive HTTP/1.1 connections. PAUs are requested by THREADS threads, first with a new connection for
+every request as XmgrProject used to make them, then through XmgrProject's pooled session. The number of requests per
+second is reported for each.
+
+    python benchmarks/xmgr_session.py --requests 2000 --threads 1 8
+"""
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import time
+
+import requests
+
+from fake_xmgr import FakeXmgr
+from themis.xmgr import XmgrProject
+
+
+def unpooled_get(xmgr, pau_id):
+    url = xmgr.urljoin(xmgr.project_url, xmgr.urljoin("wcea/api/GroundTruth/paus", pau_id))
+    r = requests.get(url, auth=(xmgr.username, xmgr.password))
+    r.raise_for_status()
+    return r.json()["hits"]
+
+
+def pooled_get(xmgr, pau_id):
+    return xmgr.get_paus(pau_id)
+
+
+def requests_per_second(get, xmgr, n, threads):
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        for _ in executor.map(lambda i: get(xmgr, str(i)), range(n)):
+            pass
+    return n / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", metavar="REQUESTS", type=int, default=2000, help="number of PAUs to request")
+    parser.add_argument("--threads", metavar="THREADS", type=int, nargs="+", default=[1, 8],
+                        help="numbers of threads making requests")
+    args = parser.parse_args()
+    with FakeXmgr(documents=args.requests, paus=1, pau_size=650) as server:
+        print("Threads\tUnpooled\tPooled")
+        for threads in args.threads:
+            xmgr = XmgrProject(server.url, "username", "password", pool_size=threads)
+            unpooled = requests_per_second(unpooled_get, xmgr, args.requests, threads)
+            pooled = requests_per_second(pooled_get, xmgr, args.requests, threads)
+            print("%d\t%0.0f\t%0.0f" % (threads, unpooled, pooled))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ setup(
     name='themis',
     version=themis.__version__,
     packages=['themis'],
+    python_requires='>=3.5',
     entry_points={
         'console_scripts': ['themis=themis.main:main'],
     },
@@ -15,9 +16,10 @@ setup(
         'watson_developer_cloud',
         'solrpy',
         'numpy',
+        'scipy',
         'matplotlib',
         'requests',
-        'pandas >= 0.17.0',
+        'pandas >= 0.20.0',
     ],
     url='https://github.ibm.com/WatsonTooling/data-science',
     license='Apache Software License',
@@ -1,9 +1,12 @@
 from __future__ import print_function
 
+import heapq
 import json
 import logging
 import os
+import pickle
 import sys
+import tempfile
 
 import pandas
 
@@ -19,6 +22,7 @@ TITLE = "Title"
 FILENAME = "Filename"
 DOCUMENT_ID = "Document Id"
 CONFIDENCE = "Confidence"
+RANK = "Rank"
 FREQUENCY = "Frequency"
 CORRECT = "Correct"
 IN_PURVIEW = "In Purview"
@@ -39,16 +43,17 @@ def print_csv(dataframe, **kwargs):
 class CsvFileType(object):
     """Pandas CSV file type used with argparse
 
-    This allows you to specify the columns you wish to use and optionally rename them.
+    This allows you to specify the columns you wish to use and optionally rename them and their types.
     """
 
-    def __init__(self, columns=None, rename=None):
+    def __init__(self, columns=None, rename=None, dtype=None):
         self.columns = columns
         self.rename = rename
+        self.dtype = dtype
 
     def __call__(self, filename):
         try:
-            csv = from_csv(filename, usecols=self.columns)
+            csv = from_csv(filename, usecols=self.columns, dtype=self.dtype)
             if self.rename is not None:
                 csv = csv.rename(columns=self.rename)
             csv.filename = filename
@@ -78,3 +83,79 @@ def ensure_directory_exists(directory):
         os.makedirs(directory)
     except OSError:
         pass
+
+
+def external_sort(items, key=None, run_size=100000, directory=None, max_bytes=None, size=None):
+    """
+    Sort items that may not all fit in memory.
+
+    Items are sorted in runs, each of which is spilled to a temporary file, and the runs are then merged. A run ends
+    when it holds run_size items or, if max_bytes is specified, when the sizes of its items add up to max_bytes. Runs
+    are read back during the merge in blocks of at most 1000 items, and at most 64 KB if max_bytes is specified. The
+    sort is stable.
+
+    :param items: items to sort, which must be picklable
+    :type items: iterable
+    :param key: function that returns the key by which to sort an item, if None sort the items themselves
+    :type key: function
+    :param run_size: maximum number of items to hold in memory, if None only limit their size
+    :type run_size: int
+    :param directory: directory in which to create the temporary files, if None use the system default
+    :type directory: str
+    :param max_bytes: maximum total size of the items to hold in memory, if None only limit their number
+    :type max_bytes: int
+    :param size: function that estimates the size of an item in bytes, if None use sys.getsizeof
+    :type size: function
+    :return: sorted items
+    :rtype: iterator
+    """
+
+    def spill(run):
+        run.sort(key=key)
+        f = tempfile.TemporaryFile(dir=directory)
+        block, block_bytes = [], 0
+        for item in run:
+            block.append(item)
+            if max_bytes is not None:
+                block_bytes += size(item)
+            if len(block) == 1000 or block_bytes >= 1 << 16:
+                pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+                block, block_bytes = [], 0
+        if block:
+            pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        return f
+
+    def read(f):
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            for item in block:
+                yield item
+
+    size = size if size is not None else sys.getsizeof
+    runs = []
+    try:
+        run, run_bytes = [], 0
+        for item in items:
+            run.append(item)
+            if max_bytes is not None:
+                run_bytes += size(item)
+            if len(run) == run_size or (max_bytes is not None and run_bytes >= max_bytes):
+                runs.append(spill(run))
+                run, run_bytes = [], 0
+        if not runs:
+            run.sort(key=key)
+            for item in run:
+                yield item
+            return
+        runs.append(spill(run))
+        del run
+        logger.debug("Merge %d sorted runs" % len(runs))
+        for item in heapq.merge(*[read(f) for f in runs], key=key):
+            yield item
+    finally:
+        for f in runs:
+            f.close()
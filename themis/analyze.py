@@ -5,10 +5,13 @@ import pandas
 from bs4 import BeautifulSoup
 from nltk import word_tokenize, FreqDist
 
-from themis import CsvFileType, QUESTION, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, FREQUENCY, logger, ANSWER_ID
+from themis import CsvFileType, QUESTION, ANSWER, CONFIDENCE, IN_PURVIEW, CORRECT, FREQUENCY, logger, ANSWER_ID, \
+    RANK
+from themis.answer import START, LATENCY, RETRIES, BYTES
 
 SYSTEM = "System"
 ANSWERING_SYSTEM = "Answering System"
+WINDOW = "Window"
 
 
 def corpus_statistics(corpus):
@@ -191,6 +194,69 @@ def truth_coverage(corpus, truth, systems_data):
          "Correct Answers in Truth", "Correct Answers in Truth %"]].sort_values("Correct Answers", ascending=False)
 
 
+def ranked_answers_accuracy(labeled_ranked_answers, truth, ks):
+    """
+    Recall at k and mean reciprocal rank of the ranked answers returned by each system, judged against the truth.
+
+    An answer to a question is correct if the truth maps the question to its answer ID. Questions that are not in the
+    truth are ignored. A question is recalled at k if one of its first k answers is correct, and its reciprocal rank is
+    one over the rank of its first correct answer, or zero if none of its answers are correct.
+
+    :param labeled_ranked_answers: system names and ranked answers created by an 'answer' command run with --top-k
+    :type labeled_ranked_answers: list of (str, pandas.DataFrame)
+    :param truth: question to answer mapping used in training
+    :type truth: pandas.DataFrame
+    :param ks: ranks at which to measure recall
+    :type ks: list of int
+    :return: number of questions judged, recall at each k, and mean reciprocal rank for each system
+    :rtype: pandas.DataFrame
+    """
+    truth = truth[[QUESTION, ANSWER_ID]].drop_duplicates().astype({ANSWER_ID: str})
+    recall_columns = ["Recall@%d" % k for k in ks]
+    summary = []
+    for label, ranked in labeled_ranked_answers:
+        in_truth = ranked[QUESTION].isin(truth[QUESTION])
+        n = ranked[QUESTION].nunique()
+        m = ranked.loc[~in_truth, QUESTION].nunique()
+        if m:
+            logger.warning("%d of %d questions answered by %s not in truth (%0.3f%%)" % (m, n, label, 100.0 * m / n))
+        ranked = ranked[in_truth].dropna(subset=[ANSWER_ID]).astype({ANSWER_ID: str})
+        questions = n - m
+        first_correct = pandas.merge(ranked, truth, on=[QUESTION, ANSWER_ID]).groupby(QUESTION)[RANK].min()
+        recall = [float((first_correct <= k).sum()) / questions if questions else None for k in ks]
+        mrr = (1.0 / first_correct).sum() / questions if questions else None
+        summary.append([label, questions] + recall + [mrr])
+    summary = pandas.DataFrame(summary, columns=[SYSTEM, "Questions"] + recall_columns + ["MRR"])
+    return summary.set_index(SYSTEM)
+
+
+def latency_percentiles(labeled_latencies, window=None):
+    """
+    Percentiles of the time each system took to answer questions, optionally broken down into windows of time.
+
+    :param labeled_latencies: system names and latencies written by an 'answer' command
+    :type labeled_latencies: list of (str, pandas.DataFrame)
+    :param window: length of the time windows as a pandas offset alias such as "10min", if None do not use windows
+    :type window: str
+    :return: number of questions, 50th, 90th and 99th percentile and maximum latency in seconds, total retries and mean
+             bytes returned for each system and window
+    :rtype: pandas.DataFrame
+    """
+    latencies = pandas.concat([latencies.assign(**{SYSTEM: label}) for label, latencies in labeled_latencies])
+    keys = [SYSTEM]
+    if window is not None:
+        latencies[WINDOW] = pandas.to_datetime(latencies[START], unit="s").dt.floor(window)
+        keys.append(WINDOW)
+    systems = latencies.groupby(keys)
+    summary = pandas.DataFrame({"Questions": systems[LATENCY].count()})
+    for percentile in [50, 90, 99]:
+        summary["p%d" % percentile] = systems[LATENCY].quantile(percentile / 100.0)
+    summary["Max"] = systems[LATENCY].max()
+    summary[RETRIES] = systems[RETRIES].sum()
+    summary["Mean Bytes"] = systems[BYTES].mean()
+    return summary
+
+
 def in_purview_disagreement(systems_data):
     """
     Return collated data where in-purview judgments are not unanimous for a question.
@@ -1,17 +1,45 @@
+import json
+import os
 import re
+import threading
+import time
 
 import pandas
+import requests
 # noinspection PyPackageRequirements
 import solr
 from themis import logger, percent_complete_message, CsvFileType
-from themis.checkpoint import DataFrameCheckpoint
-from themis import QUESTION, ANSWER, CONFIDENCE
+from themis.checkpoint import DataFrameCheckpoint, dead_letter_checkpoint, dead_letters, map_items, CatchErrors
+from themis import QUESTION, ANSWER, ANSWER_ID, CONFIDENCE, RANK
+from themis.throttle import RetryPolicy, host_name, call_statistics
 
+START = "Start"
+LATENCY = "Latency"
+RETRIES = "Retries"
+BYTES = "Bytes"
 
-def answer_questions(system, questions, output_filename, checkpoint_frequency):
+
+def answer_questions(system, questions, output_filename, checkpoint_frequency, concurrency=None, top_k=None):
     """
     Use a Q&A system to provide answers to a test set of questions
 
+    Several questions may be asked at once by a pool of threads, in which case the system's ask method must be
+    thread-safe. Answers are written to the output file in question order regardless.
+
+    If top_k is specified the system's ask_top_k method is used to get its k best answers to each question. These are
+    written to the output file as one row per answer containing the question, the rank of the answer, its answer ID and
+    its confidence. A question with no answers is written as a single row with only the question filled in.
+
+    If the system has ask_batch and ask_top_k_batch methods, which take a list of questions and return a list of
+    answers, questions are passed to them in batches of checkpoint_frequency.
+
+    Questions that the system fails to answer because of an error are written to a dead letter file next to the output
+    file and will be asked again by a subsequent run.
+
+    The time at which each answered question was asked, how long it took to answer, how many times the request was
+    retried and how many bytes the system returned are written to a latency file next to the output file. Questions
+    asked in a batch are each assigned an equal share of the batch's latency and bytes, and all of its retries.
+
     :param system: Q&A system
     :type system: object that exports an ask method
     :param questions: questions to ask
@@ -20,23 +48,100 @@ def answer_questions(system, questions, output_filename, checkpoint_frequency):
     :type output_filename: str
     :param checkpoint_frequency: how often to write intermediary results to the output file
     :type checkpoint_frequency: int
+    :param concurrency: number of questions to ask at once, if None ask them one at a time
+    :type concurrency: int
+    :param top_k: number of ranked answers to get for each question, if None just get the best one
+    :type top_k: int
     """
+
+    batched = hasattr(system, "ask_batch")
+
+    def ask(batch):
+        # NLC and Solr cannot handle newlines in questions.
+        batch = [question.replace("\n", " ") for question in batch]
+        if top_k is not None:
+            if batched:
+                return system.ask_top_k_batch(batch, top_k)
+            return [system.ask_top_k(question, top_k) for question in batch]
+        if batched:
+            return [[answer] for answer in system.ask_batch(batch)]
+        return [[system.ask(question)] for question in batch]
+
     logger.info("Get answers to %d questions from %s" % (len(questions), system))
-    answers = DataFrameCheckpoint(output_filename, [QUESTION, ANSWER, CONFIDENCE], checkpoint_frequency)
+    columns = AnswersFileType.columns if top_k is None else RankedAnswersFileType.columns
+    # Flush explicitly after whole questions so that a question's ranked answers are never split across a restart.
+    latencies = DataFrameCheckpoint(latency_filename(output_filename), LatencyFileType.columns)
+    answers = DataFrameCheckpoint(output_filename, columns, dependents=[latencies])
+    dead_letter = dead_letter_checkpoint(dead_letter_filename(output_filename), QUESTION)
     try:
         if answers.recovered:
             logger.info("Recovered %d answers from %s" % (len(answers.recovered), output_filename))
         questions = sorted(questions - answers.recovered)
+        batch_size = checkpoint_frequency if batched else 1
+        batches = [questions[j:j + batch_size] for j in range(0, len(questions), batch_size)]
         n = len(answers.recovered) + len(questions)
-        for i, question in enumerate(questions, len(answers.recovered) + 1):
-            if i is 1 or i == n or i % checkpoint_frequency is 0:
-                logger.info(percent_complete_message("Question", i, n))
-            # NLC and Solr cannot handle newlines in questions.
-            answer, confidence = system.ask(question.replace("\n", " "))
-            logger.debug("%s\t%s\t%s" % (question, answer, confidence))
-            answers.write(question, answer, confidence)
+        i = len(answers.recovered)
+        start = time.time()
+        calls = map_items(TimedCall(ask), batches, concurrency)
+        for batch, (results, error, asked_at, latency, retries, size) in calls:
+            for question, ranked in zip(batch, results if error is None else [None] * len(batch)):
+                i += 1
+                if i == 1 or i == n or i % checkpoint_frequency == 0:
+                    asked = i - len(answers.recovered)
+                    logger.info("%s, %0.1f questions per second" %
+                                (percent_complete_message("Question", i, n), asked / max(time.time() - start, 1e-3)))
+                if error is not None:
+                    logger.warning("Could not answer %s: %s" % (question, error))
+                    dead_letter.write(question, str(error))
+                else:
+                    # A question that could not be answered is asked again by a later run, which records its latency.
+                    latencies.write(question, asked_at, latency / len(batch), retries, size // len(batch))
+                    if top_k is None:
+                        answer, confidence = ranked[0]
+                        logger.debug("%s\t%s\t%s" % (question, answer, confidence))
+                        answers.write(question, answer, confidence)
+                    elif ranked:
+                        for rank, (answer_id, confidence) in enumerate(ranked, 1):
+                            logger.debug("%s\t%d\t%s\t%s" % (question, rank, answer_id, confidence))
+                            answers.write(question, rank, answer_id, confidence)
+                    else:
+                        answers.write(question, None, None, None)
+                if i % checkpoint_frequency == 0:
+                    answers.flush()
     finally:
         answers.close()
+        latencies.close()
+        dead_letter.close()
+    failed = dead_letters(dead_letter)
+    if failed:
+        logger.warning("Could not answer %d questions, listed in %s" % (failed, dead_letter.filename()))
+    else:
+        dead_letter.remove()
+
+
+def dead_letter_filename(output_filename):
+    root, extension = os.path.splitext(output_filename)
+    return "%s.dead-letter%s" % (root, extension or ".csv")
+
+
+def latency_filename(output_filename):
+    root, extension = os.path.splitext(output_filename)
+    return "%s.latency%s" % (root, extension or ".csv")
+
+
+class TimedCall(CatchErrors):
+    """
+    Time a call to a function that makes requests to a remote service and catch any error it raises.
+
+    Returns the function's value and error as CatchErrors does, followed by the time at which the call was made, how
+    long it took, and the number of retries made and bytes received by the requests the function made.
+    """
+
+    def __call__(self, item):
+        call_statistics.reset()
+        start = time.time()
+        value, error = super(TimedCall, self).__call__(item)
+        return value, error, start, time.time() - start, call_statistics.retries, call_statistics.bytes
 
 
 def get_answers_from_usage_log(questions, qa_pairs_from_logs):
@@ -65,20 +170,42 @@ class Solr(object):
     # TODO Missing the full reserved set: + - && || ! ( ) { } [ ] ^ " ~ * ? : \
     SOLR_CHARS = re.compile(r"""([\+\-!\[\](){}^"~*?:\\])""")
 
-    def __init__(self, url):
+    def __init__(self, url, retry_policy=None):
         self.url = url
-        self.connection = solr.SolrConnection(self.url)
+        # Solr connections cannot be shared between threads, so each thread gets its own.
+        self.connections = threading.local()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
 
     def __repr__(self):
         return "Solr: %s" % self.url
 
+    def fingerprint(self):
+        """
+        Identify this system by its URL and the version of its index, which changes whenever the index does.
+
+        If the version of the index cannot be read, the system cannot be identified and None is returned.
+        """
+        try:
+            r = requests.get(self.url.rstrip("/") + "/admin/luke", params={"wt": "json", "numTerms": 0})
+            r.raise_for_status()
+            version = r.json()["index"]["version"]
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logger.warning("Cannot get index version from %s: %s" % (self.url, e))
+            return None
+        if version is None:
+            logger.warning("No index version from %s" % self.url)
+            return None
+        return "Solr %s, index version %s" % (self.url, version)
+
+    @property
+    def connection(self):
+        if not hasattr(self.connections, "connection"):
+            self.connections.connection = solr.SolrConnection(self.url)
+        return self.connections.connection
+
     def ask(self, question):
-        question = self.escape_solr_query(question)
-        logger.debug(question)
-        r = self.connection.query(question).results
-        n = len(r)
-        logger.debug("%d results" % n)
-        if n:
+        r = self.query(question)
+        if r:
             answer = r[0][ANSWER][0]
             confidence = r[0]["score"]
         else:
@@ -86,6 +213,23 @@ class Solr(object):
             confidence = None
         return answer, confidence
 
+    def ask_top_k(self, question, k):
+        """
+        :return: answer IDs and confidences of the k best answers, best first
+        :rtype: list of (str, float)
+        """
+        return [(result[ANSWER_ID], result["score"]) for result in self.query(question, k)]
+
+    def query(self, question, rows=None):
+        question = self.escape_solr_query(question)
+        logger.debug(question)
+        params = {} if rows is None else {"rows": rows}
+        r = self.retry_policy.call(host_name(self.url), self.connection.query, question, **params).results
+        # solrpy does not expose the response body, so measure the JSON encoding of the results instead.
+        call_statistics.bytes += len(json.dumps(r, default=str))
+        logger.debug("%d results" % len(r))
+        return r
+
     def escape_solr_query(self, s):
         s = s.replace("/", "\\/")
         return re.sub(self.SOLR_CHARS, lambda m: "\%s" % m.group(1), s)
@@ -95,6 +239,28 @@ class AnswersFileType(CsvFileType):
     """
     Questions answered by a system
     """
+    columns = [QUESTION, ANSWER, CONFIDENCE]
+
+    def __init__(self):
+        super(self.__class__, self).__init__(self.__class__.columns)
+
+
+class RankedAnswersFileType(CsvFileType):
+    """
+    Ranked answer IDs returned by a system, one row per answer
+    """
+    columns = [QUESTION, RANK, ANSWER_ID, CONFIDENCE]
+
+    def __init__(self):
+        # Read answer IDs as strings so that they can be compared with the NLC class names and Solr IDs they came from.
+        super(self.__class__, self).__init__(self.__class__.columns, dtype={ANSWER_ID: str})
+
+
+class LatencyFileType(CsvFileType):
+    """
+    Time taken to answer each question, written next to the answers file by answer_questions
+    """
+    columns = [QUESTION, START, LATENCY, RETRIES, BYTES]
 
     def __init__(self):
-        super(self.__class__, self).__init__([QUESTION, ANSWER, CONFIDENCE])
+        super(self.__class__, self).__init__(self.__class__.columns)
@@ -0,0 +1,218 @@
+"""
+An in-process BM25 search engine over the answers in a corpus, for experiments that do not need a Solr server.
+
+Answers are analyzed the same way as the text_html_en field type in solr/schema.xml: HTML markup is stripped, the text
+is tokenized, English stop words are removed, the remaining tokens are lowercased, possessives are removed and the
+tokens are Porter stemmed.
+
+The index is a sparse term by answer matrix of BM25 weights, so that a batch of questions can be scored against every
+answer with a single matrix product.
+"""
+import json
+import os
+import re
+import time
+
+import numpy
+import pandas
+import scipy.sparse
+from bs4 import BeautifulSoup
+from nltk.stem.porter import PorterStemmer
+
+from themis import logger, percent_complete_message, ensure_directory_exists, from_csv, to_csv, ANSWER, ANSWER_ID
+
+# Lucene's default English stop words, which Solr's lang/stopwords_en.txt contains.
+STOP_WORDS = frozenset(["a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it",
+                        "no", "not", "of", "on", "or", "such", "that", "the", "their", "then", "there", "these", "they",
+                        "this", "to", "was", "will", "with"])
+
+
+class Analyzer(object):
+    """
+    Turn text into index terms.
+
+    Stemming is memoized because the same tokens occur over and over again.
+    """
+    TOKEN = re.compile(r"\w+(?:'\w+)*", re.UNICODE)
+
+    def __init__(self):
+        # Lucene's PorterStemFilter implements the original algorithm, without NLTK's extensions to it.
+        self.stemmer = PorterStemmer(mode=PorterStemmer.ORIGINAL_ALGORITHM)
+        self.stems = {}
+
+    def __call__(self, text, html=False):
+        if html:
+            text = BeautifulSoup(text, "lxml").text
+        terms = []
+        for token in self.TOKEN.findall(text.lower()):
+            if token in STOP_WORDS:
+                continue
+            if token.endswith("'s"):
+                token = token[:-2]
+            stem = self.stems.get(token)
+            if stem is None:
+                stem = self.stems[token] = self.stemmer.stem(token)
+            terms.append(stem)
+        return terms
+
+
+class BM25Index(object):
+    """
+    BM25 index of the answers in a corpus
+
+    The weight of a term t in an answer d is
+
+        idf(t) * tf(t, d) * (k1 + 1) / (tf(t, d) + k1 * (1 - b + b * |d| / avgdl))
+
+    where idf(t) = log(1 + (N - df(t) + 0.5) / (df(t) + 0.5)) as in Lucene. The score of an answer for a question is the
+    sum of the weights of the question's terms, counted as many times as they appear in the question.
+
+    An index is saved as a directory of NumPy arrays which are memory-mapped when it is loaded, so that large indexes
+    can be shared by several processes without each one reading them into memory.
+    """
+
+    PARAMETERS = "parameters.json"
+    VOCABULARY = "vocabulary.json"
+    ANSWERS = "answers.csv"
+    WEIGHTS = ["data", "indices", "indptr"]
+
+    def __init__(self, answer_ids, answers, vocabulary, weights, parameters, directory=None):
+        self.answer_ids = answer_ids
+        self.answers = answers
+        self.vocabulary = vocabulary
+        self.weights = weights
+        self.parameters = parameters
+        self.directory = directory
+        self.analyzer = Analyzer()
+
+    def __repr__(self):
+        return "BM25: %s, %d answers, %d terms" % (self.directory, len(self.answer_ids), len(self.vocabulary))
+
+    @classmethod
+    def build(cls, corpus, k1=1.2, b=0.75):
+        """
+        Index the answers in a corpus.
+
+        :param corpus: corpus generated by the 'xmgr download-corpus' or 'xmgr trec-corpus' command
+        :type corpus: pandas.DataFrame
+        :param k1: term frequency saturation
+        :type k1: float
+        :param b: document length normalization
+        :type b: float
+        :return: index of the corpus
+        :rtype: BM25Index
+        """
+        corpus = corpus.drop_duplicates(ANSWER_ID)
+        analyzer = Analyzer()
+        vocabulary = {}
+        terms, documents, counts = [], [], []
+        n = len(corpus)
+        logger.info("Index %d answers" % n)
+        for document, answer in enumerate(corpus[ANSWER].fillna(""), 1):
+            frequencies = {}
+            for term in analyzer(answer, html=True):
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, count in frequencies.items():
+                terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                documents.append(document - 1)
+                counts.append(count)
+            if document % 10000 == 0 or document == n:
+                logger.info(percent_complete_message("Answer", document, n))
+        frequencies = scipy.sparse.csr_matrix((numpy.array(counts, dtype=numpy.float32), (terms, documents)),
+                                              shape=(len(vocabulary), n))
+        lengths = numpy.asarray(frequencies.sum(axis=0)).ravel()
+        average_length = float(lengths.mean()) if n else 0.0
+        document_frequencies = numpy.diff(frequencies.indptr)
+        idf = numpy.log(1 + (n - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        tf = frequencies.data
+        norm = k1 * (1 - b + b * lengths[frequencies.indices] / max(average_length, 1e-9))
+        weights = scipy.sparse.csr_matrix(
+            ((numpy.repeat(idf, document_frequencies) * tf * (k1 + 1) / (tf + norm)).astype(numpy.float32),
+             frequencies.indices.astype(numpy.int32), frequencies.indptr.astype(numpy.int32)), shape=frequencies.shape)
+        parameters = {"k1": k1, "b": b, "answers": n, "average length": average_length, "built": time.time()}
+        return cls(corpus[ANSWER_ID].values, corpus[ANSWER].values, vocabulary, weights, parameters)
+
+    def save(self, directory):
+        ensure_directory_exists(directory)
+        for name in self.WEIGHTS:
+            numpy.save(os.path.join(directory, "weights.%s.npy" % name), getattr(self.weights, name))
+        with open(os.path.join(directory, self.VOCABULARY), "w") as f:
+            json.dump(self.vocabulary, f)
+        to_csv(os.path.join(directory, self.ANSWERS),
+               pandas.DataFrame({ANSWER_ID: self.answer_ids, ANSWER: self.answers})[[ANSWER_ID, ANSWER]], index=False)
+        with open(os.path.join(directory, self.PARAMETERS), "w") as f:
+            json.dump(self.parameters, f)
+        self.directory = directory
+        logger.info("Saved %s" % self)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, cls.PARAMETERS)) as f:
+            parameters = json.load(f)
+        with open(os.path.join(directory, cls.VOCABULARY)) as f:
+            vocabulary = json.load(f)
+        answers = from_csv(os.path.join(directory, cls.ANSWERS), dtype={ANSWER_ID: str}, keep_default_na=False)
+        data, indices, indptr = [numpy.load(os.path.join(directory, "weights.%s.npy" % name), mmap_mode="r")
+                                 for name in cls.WEIGHTS]
+        weights = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(vocabulary), len(answers)), copy=False)
+        return cls(answers[ANSWER_ID].values, answers[ANSWER].values, vocabulary, weights, parameters, directory)
+
+    def fingerprint(self):
+        return "BM25 %s, built %s" % (os.path.abspath(self.directory), self.parameters["built"])
+
+    def ask(self, question):
+        return self.ask_batch([question])[0]
+
+    def ask_top_k(self, question, k):
+        """
+        :return: answer IDs and confidences of the k best answers, best first
+        :rtype: list of (str, float)
+        """
+        return self.ask_top_k_batch([question], k)[0]
+
+    def ask_batch(self, questions):
+        """
+        :return: best answer and its confidence for each question, or None and None if no answer matches
+        :rtype: list of (str, float)
+        """
+        return [(self.answers[ranked[0][0]], ranked[0][1]) if ranked else (None, None)
+                for ranked in self.rank(questions, 1)]
+
+    def ask_top_k_batch(self, questions, k):
+        """
+        :return: answer IDs and confidences of the k best answers to each question, best first
+        :rtype: list of list of (str, float)
+        """
+        return [[(self.answer_ids[document], score) for document, score in ranked]
+                for ranked in self.rank(questions, k)]
+
+    def rank(self, questions, k):
+        """
+        Score all the answers for a batch of questions.
+
+        :param questions: questions to score
+        :type questions: list of str
+        :param k: maximum number of answers to return for each question
+        :type k: int
+        :return: indexes of the best scoring answers to each question and their scores, best first, ties broken by index
+        :rtype: list of list of (int, float)
+        """
+        terms, rows = [], []
+        for row, question in enumerate(questions):
+            for term in self.analyzer(question):
+                if term in self.vocabulary:
+                    terms.append(self.vocabulary[term])
+                    rows.append(row)
+        query = scipy.sparse.csr_matrix((numpy.ones(len(terms), dtype=numpy.float32), (rows, terms)),
+                                        shape=(len(questions), len(self.vocabulary)))
+        scores = query.dot(self.weights).tocsr()
+        ranked = []
+        for row in range(len(questions)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            documents, s = scores.indices[start:end], scores.data[start:end]
+            if k < len(s):
+                best = numpy.argpartition(-s, k - 1)[:k]
+                documents, s = documents[best], s[best]
+            order = numpy.lexsort((documents, -s))
+            ranked.append([(int(documents[i]), float(s[i])) for i in order])
+        return ranked
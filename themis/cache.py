@@ -0,0 +1,262 @@
+"""
+Persistent caches of the results of calls to remote services, so that repeated experiments do not have to make the same
+calls again.
+"""
+import sqlite3
+import threading
+import time
+import zlib
+
+from themis import logger
+
+
+class AnswerCache(object):
+    """
+    An SQLite database of answers keyed by the identity of the Q&A system that gave them and the question text.
+
+    The cache may be bounded to a maximum number of entries, in which case the least recently used entries are evicted
+    when it grows past that size. Entries are evicted in batches of a tenth of the maximum size so that the cost of
+    eviction is spread over many insertions.
+
+    The cache may be shared by several threads.
+    """
+
+    def __init__(self, filename, max_entries=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS answers (system TEXT, question TEXT, answer, "
+                                    "confidence, last_used REAL, PRIMARY KEY (system, question))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def __repr__(self):
+        return "Answer cache %s: %d entries" % (self.filename, self.entries)
+
+    def get(self, system, question):
+        """
+        Look up an answer in the cache.
+
+        :param system: identity of the Q&A system
+        :type system: str
+        :param question: question text
+        :type question: str
+        :return: answer and confidence, or None if the question is not in the cache
+        :rtype: (str, float)
+        """
+        with self.lock, self.connection:
+            r = self.connection.execute("SELECT answer, confidence FROM answers WHERE system = ? AND question = ?",
+                                        (system, question)).fetchone()
+            if r is not None:
+                self.connection.execute("UPDATE answers SET last_used = ? WHERE system = ? AND question = ?",
+                                        (time.time(), system, question))
+        return r
+
+    def put(self, system, question, answer, confidence):
+        with self.lock, self.connection:
+            updated = self.connection.execute(
+                "UPDATE answers SET answer = ?, confidence = ?, last_used = ? WHERE system = ? AND question = ?",
+                (answer, confidence, time.time(), system, question)).rowcount
+            if not updated:
+                self.connection.execute("INSERT INTO answers VALUES (?, ?, ?, ?, ?)",
+                                        (system, question, answer, confidence, time.time()))
+                self.entries += 1
+            if self.max_entries is not None and self.entries > self.max_entries:
+                self.evict(self.max_entries - max(self.max_entries // 10, 1))
+
+    def stats(self):
+        """
+        :return: number of entries and the time the least and most recently used entries were used for each system
+        :rtype: list of (str, int, float, float)
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT system, COUNT(*), MIN(last_used), MAX(last_used) FROM answers GROUP BY system ORDER BY system"
+            ).fetchall()
+
+    def prune(self, max_entries, system=None):
+        """
+        Evict the least recently used entries until there are at most a specified number.
+
+        :param max_entries: maximum number of entries to keep
+        :type max_entries: int
+        :param system: if specified, only prune entries for this system
+        :type system: str
+        :return: number of entries evicted
+        :rtype: int
+        """
+        with self.lock, self.connection:
+            if system is None:
+                return self.evict(max_entries)
+            n = self.connection.execute(
+                "DELETE FROM answers WHERE system = ? AND question NOT IN "
+                "(SELECT question FROM answers WHERE system = ? ORDER BY last_used DESC LIMIT ?)",
+                (system, system, max_entries)).rowcount
+            self.entries -= n
+            return n
+
+    def evict(self, max_entries):
+        n = self.connection.execute(
+            "DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers ORDER BY last_used LIMIT ?)",
+            (max(self.entries - max_entries, 0),)).rowcount
+        self.entries -= n
+        logger.debug("Evicted %d entries from %s" % (n, self.filename))
+        return n
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedSystem(object):
+    """
+    A Q&A system that looks up answers in a cache before asking them of the underlying system.
+
+    The underlying system must have a fingerprint method that returns a string identifying it, such that it gives the
+    same answers to the same questions as any other system with the same fingerprint. If it returns None instead, the
+    system cannot be identified, so every question is asked of it and none of its answers are cached.
+    """
+
+    def __init__(self, system, cache):
+        self.system = system
+        self.cache = cache
+        self.fingerprint = system.fingerprint()
+        if self.fingerprint is None:
+            logger.warning("Cannot identify %s, so its answers will not be cached" % system)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "%s, cached as %s in %s" % (self.system, self.fingerprint, self.cache.filename)
+
+    def ask(self, question):
+        question = self.normalize(question)
+        r = self.cache.get(self.fingerprint, question) if self.fingerprint is not None else None
+        with self.lock:
+            if r is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if r is not None:
+            return tuple(r)
+        answer, confidence = self.system.ask(question)
+        if self.fingerprint is not None:
+            self.cache.put(self.fingerprint, question, answer, confidence)
+        return answer, confidence
+
+    @staticmethod
+    def normalize(question):
+        # NLC and Solr cannot handle newlines in questions, so they are replaced before asking.
+        return question.replace("\n", " ")
+
+
+class CachedBatchSystem(CachedSystem):
+    """
+    A cached Q&A system whose underlying system answers batches of questions with an ask_batch method.
+
+    Only the questions in a batch that are not in the cache are asked of the underlying system, in a single batch.
+    """
+
+    def ask_batch(self, questions):
+        questions = [self.normalize(question) for question in questions]
+        cached = [self.cache.get(self.fingerprint, question) if self.fingerprint is not None else None
+                  for question in questions]
+        uncached = [question for question, r in zip(questions, cached) if r is None]
+        with self.lock:
+            self.hits += len(questions) - len(uncached)
+            self.misses += len(uncached)
+        answers = iter(self.system.ask_batch(uncached) if uncached else [])
+        results = []
+        for question, r in zip(questions, cached):
+            if r is None:
+                r = next(answers)
+                if self.fingerprint is not None:
+                    self.cache.put(self.fingerprint, question, *r)
+            results.append(tuple(r))
+        return results
+
+
+class ResponseCache(object):
+    """
+    An SQLite database of compressed HTTP response bodies keyed by request, along with the ETag and Last-Modified
+    headers the server sent with them so that they can be revalidated.
+
+    Responses younger than a time to live are used without asking the server. Older ones are revalidated with a
+    conditional request if the server sent validators, otherwise they are requested again. The total size of the
+    compressed bodies may be bounded, in which case the least recently used responses are evicted when the cache grows
+    past that size.
+
+    The cache may be shared by several threads.
+    """
+
+    def __init__(self, filename, ttl=None, max_bytes=None):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (request TEXT PRIMARY KEY, body BLOB, "
+                                    "etag TEXT, last_modified TEXT, stored REAL, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.bytes = self.connection.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+
+    def __repr__(self):
+        return "Response cache %s: %d bytes" % (self.filename, self.bytes)
+
+    def get(self, request):
+        """
+        Look up a response in the cache.
+
+        :param request: URL and parameters of the request
+        :type request: str
+        :return: response body, ETag, Last-Modified and whether the response is younger than the time to live, or None
+                 if the request is not in the cache
+        :rtype: (bytes, str, str, bool)
+        """
+        with self.lock, self.connection:
+            r = self.connection.execute("SELECT body, etag, last_modified, stored FROM responses WHERE request = ?",
+                                        (request,)).fetchone()
+            if r is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE request = ?", (time.time(), request))
+        body, etag, last_modified, stored = r
+        fresh = self.ttl is not None and time.time() - stored < self.ttl
+        return zlib.decompress(body), etag, last_modified, fresh
+
+    def put(self, request, body, etag=None, last_modified=None):
+        body = sqlite3.Binary(zlib.compress(body))
+        now = time.time()
+        with self.lock, self.connection:
+            r = self.connection.execute("SELECT LENGTH(body) FROM responses WHERE request = ?", (request,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                    (request, body, etag, last_modified, now, now))
+            self.bytes += len(body) - (r[0] if r is not None else 0)
+            if self.max_bytes is not None and self.bytes > self.max_bytes:
+                self.evict(self.max_bytes - self.max_bytes // 10)
+
+    def revalidated(self, request):
+        """
+        Restart the time to live of a cached response that the server said has not changed.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE responses SET stored = ? WHERE request = ?", (time.time(), request))
+
+    def evict(self, max_bytes):
+        n = 0
+        for request, size in self.connection.execute(
+                "SELECT request, LENGTH(body) FROM responses ORDER BY last_used").fetchall():
+            if self.bytes <= max_bytes:
+                break
+            self.connection.execute("DELETE FROM responses WHERE request = ?", (request,))
+            self.bytes -= size
+            n += 1
+        logger.debug("Evicted %d responses from %s" % (n, self.filename))
+        return n
+
+    def close(self):
+        self.connection.close()
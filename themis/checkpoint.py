@@ -2,18 +2,38 @@
 Checkpointing provides a framework for writing intermediary results of long-running operations to disk so that they can
 resume where they left off if they fail in the middle.
 """
+import collections
+import concurrent.futures
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import sqlite3
 import time
+import zlib
 
 import pandas
 
-from themis import logger, percent_complete_message
+from themis import logger, percent_complete_message, from_csv
 
+ERROR = "Error"
 
-def get_items(item_type, names, checkpoint, get_item, write_frequency):
+
+def get_items(item_type, names, checkpoint, get_item, write_frequency, workers=None, processes=False,
+              dead_letter=None, chunk_size=None):
     """
     Given a list of item names and a checkpoint, this function recovers any previously checkpointed items, then gets
     the remaining items and writes them to a checkpoint.
 
+    Items may be gotten concurrently by a pool of workers. Items are still written to the checkpoint one at a time in
+    name order by the calling thread, so an interrupted run resumes from the items that made it into the checkpoint.
+
+    If a dead letter checkpoint is specified, items that cannot be gotten because get_item raises an exception are
+    written to it along with the error instead of stopping the run. They are not written to the checkpoint, so they
+    will be tried again by a subsequent run.
+
     :param item_type: name of item type for use in logging
     :type item_type: str
     :param names: list of item names
@@ -24,6 +44,14 @@ def get_items(item_type, names, checkpoint, get_item, write_frequency):
     :type get_item: func
     :param write_frequency: how often to log a process message
     :type write_frequency: int
+    :param workers: number of items to get concurrently, if None get them one at a time
+    :type workers: int
+    :param processes: use a pool of processes instead of threads, in which case get_item must be picklable
+    :type processes: bool
+    :param dead_letter: optional checkpoint to write the names of items that could not be gotten to
+    :type dead_letter: DataFrameCheckpoint
+    :param chunk_size: number of items to send to a worker at a time, if None send them one at a time
+    :type chunk_size: int
     :return: the checkpoint
     :rtype: DataFrameCheckpoint
     """
@@ -32,58 +60,518 @@ def get_items(item_type, names, checkpoint, get_item, write_frequency):
         logger.info("Recovered %d %s from previous run" % (len(recovered), item_type))
     total = len(names)
     start = 1 + len(recovered)
+    if dead_letter is not None:
+        get_item = CatchErrors(get_item)
     try:
         names_to_get = sorted(set(names) - recovered)
-        for i, name in enumerate(names_to_get, start):
+        for i, (name, item) in enumerate(map_items(get_item, names_to_get, workers, processes, chunk_size), start):
             if i == start or i == total or i % write_frequency == 0:
                 logger.info("Get " + percent_complete_message(item_type, i, total))
-            item = get_item(name)
+            if dead_letter is not None:
+                item, error = item
+                if error is not None:
+                    logger.warning("Could not get %s: %s" % (name, error))
+                    dead_letter.write(name, str(error))
+                    continue
             checkpoint.write(name, item)
     finally:
         checkpoint.close()
+        if dead_letter is not None:
+            dead_letter.close()
     return checkpoint
 
 
-class DataFrameCheckpoint(object):
-    def __init__(self, output_filename, columns, interval=None):
+def map_items(function, items, workers=None, processes=False, chunk_size=None):
+    """
+    Apply a function to a sequence of items, optionally using a pool of workers.
+
+    Results are yielded in the same order as the items. At most twice as many items as there are workers are submitted
+    to the pool ahead of the one being yielded, so that the items do not all have to be held in memory. If the caller
+    stops iterating, items that have not started running are cancelled.
+
+    Items may be submitted to the pool in chunks, which amortizes the cost of sending them to a pool of processes when
+    the function is quick. Results are still yielded one item at a time.
+
+    :param function: function to apply to each item
+    :type function: func
+    :param items: items to apply the function to
+    :type items: iterable
+    :param workers: size of the worker pool, if None apply the function in the calling thread
+    :type workers: int
+    :param processes: use a pool of processes instead of threads
+    :type processes: bool
+    :param chunk_size: number of items to submit to the pool at a time, if None submit them one at a time
+    :type chunk_size: int
+    :return: item and function result pairs
+    :rtype: iterator of (object, object)
+    """
+    if workers is None:
+        for item in items:
+            yield item, function(item)
+        return
+    if chunk_size is not None:
+        for chunk, results in map_items(ApplyToChunk(function), chunks(items, chunk_size), workers, processes):
+            for item, result in zip(chunk, results):
+                yield item, result
+        return
+    executor_type = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    with executor_type(workers) as executor:
+        pending = collections.deque()
         try:
-            recovered = pandas.read_csv(open(output_filename), usecols=[0], encoding="utf-8")
-            self.recovered = set(recovered[recovered.columns[0]])
-            self.need_header = False
-            logger.debug("Recovered %d items from disk" % len(self.recovered))
-        except IOError:
-            self.recovered = set()
-            self.need_header = True
+            for item in items:
+                pending.append((item, executor.submit(function, item)))
+                if len(pending) >= 2 * workers:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def chunks(items, chunk_size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ApplyToChunk(object):
+    """
+    Apply a function to each item in a list.
+
+    This is picklable if the function is, so that it can be sent to a pool of processes.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, chunk):
+        return [self.function(item) for item in chunk]
+
+
+class Shard(object):
+    """
+    One of N partitions of a set of items, chosen by a stable hash of the item names.
+
+    Shards are numbered from 1 to N. Separate processes, possibly on separate machines, can each work on a different
+    shard of the same items and write their results to their own files.
+    """
+
+    def __init__(self, index, count):
+        if not 1 <= index <= count:
+            raise ValueError("Invalid shard %d of %d" % (index, count))
+        self.index = index
+        self.count = count
+
+    def __repr__(self):
+        return "%d/%d" % (self.index, self.count)
+
+    def __contains__(self, name):
+        return zlib.crc32(str(name).encode("utf-8")) % self.count == self.index - 1
+
+    @classmethod
+    def parse(cls, s):
+        """
+        Parse a shard specification of the form i/N, for use as an argparse type.
+        """
+        try:
+            index, count = s.split("/")
+            return cls(int(index), int(count))
         except ValueError:
-            raise Exception("Cannot recover data from %s" % output_filename)
-        self.output_file = open(output_filename, "a")
+            raise ValueError("Invalid shard specification %s, must be i/N" % s)
+
+    def select(self, names):
+        return [name for name in names if name in self]
+
+    def filename(self, filename, sidecar=None):
+        """
+        Name of the file a shard writes its part of the results to, e.g. corpus.2-of-4.csv for corpus.csv.
+
+        A sidecar file written alongside the results is named after them with the sidecar name before the extension,
+        e.g. corpus.2-of-4.documents.csv, so that it does not match a corpus.*-of-4.csv pattern for the shard files.
+        """
+        root, extension = os.path.splitext(filename)
+        return "%s.%d-of-%d%s%s" % (root, self.index, self.count, sidecar_extension(sidecar), extension)
+
+
+def shard_filename(filename, shard, sidecar=None):
+    if shard is not None:
+        return shard.filename(filename, sidecar)
+    root, extension = os.path.splitext(filename)
+    return root + sidecar_extension(sidecar) + extension
+
+
+def sidecar_extension(sidecar):
+    return "." + sidecar if sidecar is not None else ""
+
+
+class CatchErrors(object):
+    """
+    Wrap a function so that it returns a (value, None) pair when it succeeds and a (None, error) pair when it raises an
+    exception.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, item):
+        try:
+            return self.function(item), None
+        except Exception as e:
+            return None, e
+
+
+def dead_letter_checkpoint(filename, key):
+    """
+    Create a checkpoint to write items that could not be gotten to, along with the reason why.
+
+    Any dead letter file left by a previous run is removed, because those items will be tried again.
+
+    :param filename: name of the dead letter file
+    :type filename: str
+    :param key: name of the column that identifies the items
+    :type key: str
+    :return: dead letter checkpoint
+    :rtype: DataFrameCheckpoint
+    """
+    remove_checkpoint(filename)
+    return DataFrameCheckpoint(filename, [key, ERROR])
+
+
+def dead_letters(dead_letter):
+    """
+    Number of items written to a closed dead letter checkpoint.
+    """
+    return len(dead_letter.read())
+
+
+class DataFrameCheckpoint(object):
+    """
+    A CSV file that rows are appended to in batches.
+
+    Rows are buffered in a list and appended to the file with a CSV writer when the buffer is flushed, so that the cost
+    of a flush is proportional to the number of rows being written. The file format is the same as the one written by
+    pandas.DataFrame.to_csv without an index, so the checkpoint may be read back with from_csv.
+
+    Flushes are atomic. After the rows have been written and synced to disk, the size of the file is recorded in a
+    commit file that is replaced with a rename. When the checkpoint is recovered, anything past the committed size was
+    written by a flush that did not finish, so it is truncated. This ensures that every item is written exactly once
+    across restarts. The size of the file when the checkpoint is opened is committed before anything is written to it,
+    so the first flush is protected too. The commit file is removed when the checkpoint is closed.
+
+    A checkpoint may have dependent checkpoints that contain further rows for the items it records, such as the PAUs in
+    a downloaded document. Dependents are flushed along with the checkpoint and their positions are committed with it,
+    so that they are truncated back to a state consistent with the recovered items.
+    """
+
+    def __init__(self, output_filename, columns, interval=None, dependents=()):
+        commit = read_commit(output_filename)
+        if commit is not None and os.path.isfile(output_filename) and \
+                os.path.getsize(output_filename) > commit["position"]:
+            logger.info("Discard uncommitted data from %s" % output_filename)
+            with open(output_filename, "r+b") as f:
+                f.truncate(commit["position"])
+        self.recovered, self.need_header = self.recover(output_filename)
+        self.output_file = io.open(output_filename, "a", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.output_file, lineterminator="\n")
         self.columns = columns
-        self.buffer = pandas.DataFrame(columns=self.columns)
+        self.buffer = []
         self.interval = interval
+        self.dependents = list(dependents)
+        recover_dependents(self.dependents, commit, self.need_header)
+        self.commit()
 
     def __repr__(self):
         return "%s (%s): %s, %d items in buffer" % \
                (self.__class__.__name__, self.filename(), ", ".join(self.columns), len(self.buffer))
 
+    @staticmethod
+    def recover(output_filename):
+        try:
+            recovered = pandas.read_csv(open(output_filename), usecols=[0], encoding="utf-8")
+            logger.debug("Recovered %d items from disk" % len(recovered))
+            return set(recovered[recovered.columns[0]]), False
+        except IOError:
+            return set(), True
+        except pandas.errors.EmptyDataError:
+            return set(), True
+        except ValueError:
+            raise Exception("Cannot recover data from %s" % output_filename)
+
     def filename(self):
         return self.output_file.name
 
+    def read(self):
+        return from_csv(self.filename())
+
+    def read_rows(self):
+        """
+        Read the rows in the checkpoint one at a time without loading them all into memory.
+
+        :return: rows with their values as strings, missing values as empty strings
+        :rtype: iterator of list of str
+        """
+        with io.open(self.filename(), encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                yield row
+
+    def position(self):
+        return os.fstat(self.output_file.fileno()).st_size
+
+    def truncate(self, position):
+        """
+        Discard everything written to the checkpoint file past a position it had when it was committed.
+        """
+        if self.position() > position:
+            logger.info("Discard data from %s not committed by a parent checkpoint" % self.filename())
+            self.output_file.truncate(position)
+            self.recovered, self.need_header = self.recover(self.filename())
+            write_commit(self.filename(), self.position(), {})
+
+    def remove(self):
+        remove_checkpoint(self.filename())
+
     def write(self, *values):
-        self.buffer = self.buffer.append(dict(zip(self.buffer.columns, values)), ignore_index=True)
-        if self.interval is not None and len(self.buffer) % self.interval is 0:
+        self.buffer.append([self.csv_value(value) for value in values])
+        if self.interval is not None and len(self.buffer) % self.interval == 0:
             self.flush()
 
     def close(self):
+        if self.output_file.closed:
+            return
         self.flush()
         self.output_file.close()
+        # Everything in the file has been committed, so the record is no longer needed. Left behind, it would be
+        # trusted by a later run that writes to a file of the same name that has since been replaced.
+        if os.path.isfile(commit_filename(self.filename())):
+            os.remove(commit_filename(self.filename()))
 
     def flush(self):
+        for dependent in self.dependents:
+            dependent.flush()
         logger.debug("Flush %d items to %s" % (len(self.buffer), self.output_file.name))
-        self.buffer.to_csv(self.output_file, header=self.need_header, index=False, encoding="utf-8")
+        if self.need_header:
+            self.writer.writerow(self.columns)
+        self.writer.writerows(self.buffer)
         self.output_file.flush()
-        self.buffer = pandas.DataFrame(columns=self.columns)
+        os.fsync(self.output_file.fileno())
+        self.commit()
+        self.buffer = []
         self.need_header = False
 
+    def commit(self):
+        write_commit(self.filename(), self.position(),
+                     dict((dependent.filename(), dependent.position()) for dependent in self.dependents))
+
+    @staticmethod
+    def csv_value(value):
+        # Write missing values as empty fields the way pandas does.
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return ""
+        return value
+
+
+class JournalCheckpoint(object):
+    """
+    A checkpoint stored as an append-only journal in an SQLite database.
+
+    Rows are stored in insertion order with the value of the first column, which identifies the item, held in a
+    separate indexed key column that keeps its type and the remaining values serialized as a JSON list. Recovering the
+    set of items written by a previous run only reads the key index, so restarts do not rescan the payloads. Buffered
+    rows are committed in a single transaction when the checkpoint is flushed, along with the positions of any dependent
+    checkpoints, as described for DataFrameCheckpoint.
+
+    The journal can be exported to the CSV file a DataFrameCheckpoint with the same columns would have written.
+    """
+
+    def __init__(self, output_filename, columns, interval=None, dependents=()):
+        self.connection = sqlite3.connect(output_filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS columns (position INTEGER PRIMARY KEY, name TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rows (sequence INTEGER PRIMARY KEY, key, payload TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS rows_key ON rows (key)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS dependents (filename TEXT PRIMARY KEY, position INTEGER)")
+        recovered_columns = self.journal_columns(self.connection)
+        new = not recovered_columns
+        if new:
+            with self.connection:
+                self.connection.executemany("INSERT INTO columns VALUES (?, ?)", enumerate(columns))
+        elif not recovered_columns == list(columns):
+            raise Exception("Cannot recover data from %s: columns %s do not match %s" %
+                            (output_filename, ", ".join(recovered_columns), ", ".join(columns)))
+        self.recovered = self.recover()
+        logger.debug("Recovered %d items from disk" % len(self.recovered))
+        self.output_filename = output_filename
+        self.columns = columns
+        self.buffer = []
+        self.interval = interval
+        self.dependents = list(dependents)
+        commit = {"dependents": dict(self.connection.execute("SELECT filename, position FROM dependents"))}
+        recover_dependents(self.dependents, commit, new)
+
+    def __repr__(self):
+        return "%s (%s): %s, %d items in buffer" % \
+               (self.__class__.__name__, self.filename(), ", ".join(self.columns), len(self.buffer))
+
+    def recover(self):
+        return set(key for (key,) in self.connection.execute("SELECT DISTINCT key FROM rows"))
+
+    def filename(self):
+        return self.output_filename
+
+    def read(self):
+        connection = sqlite3.connect(self.output_filename)
+        try:
+            return pandas.DataFrame(list(self.rows(connection)), columns=self.columns)
+        finally:
+            connection.close()
+
+    def read_rows(self):
+        """
+        Read the rows in the journal one at a time without loading them all into memory.
+
+        :return: rows with their values as strings, missing values as empty strings, as a DataFrameCheckpoint reads them
+        :rtype: iterator of list of str
+        """
+        connection = sqlite3.connect(self.output_filename)
+        try:
+            for row in self.rows(connection):
+                yield [str(DataFrameCheckpoint.csv_value(value)) for value in row]
+        finally:
+            connection.close()
+
+    def position(self):
+        return self.connection.execute("SELECT COALESCE(MAX(sequence), 0) FROM rows").fetchone()[0]
+
+    def truncate(self, position):
+        """
+        Discard every row written after a position the journal had when it was committed.
+        """
+        if self.position() > position:
+            logger.info("Discard data from %s not committed by a parent checkpoint" % self.filename())
+            with self.connection:
+                self.connection.execute("DELETE FROM rows WHERE sequence > ?", (position,))
+            self.recovered = self.recover()
+
+    def remove(self):
+        os.remove(self.output_filename)
+
+    def write(self, *values):
+        self.buffer.append((values[0], json.dumps(values[1:])))
+        if self.interval is not None and len(self.buffer) % self.interval == 0:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def flush(self):
+        for dependent in self.dependents:
+            dependent.flush()
+        logger.debug("Flush %d items to %s" % (len(self.buffer), self.output_filename))
+        with self.connection:
+            self.connection.executemany("INSERT INTO rows (key, payload) VALUES (?, ?)", self.buffer)
+            self.connection.executemany("INSERT OR REPLACE INTO dependents VALUES (?, ?)",
+                                        [(dependent.filename(), dependent.position()) for dependent in self.dependents])
+        self.buffer = []
+
+    @staticmethod
+    def journal_columns(connection):
+        return [name for (name,) in connection.execute("SELECT name FROM columns ORDER BY position")]
+
+    @staticmethod
+    def rows(connection):
+        for key, payload in connection.execute("SELECT key, payload FROM rows ORDER BY sequence"):
+            yield [key] + json.loads(payload)
+
+    @classmethod
+    def export(cls, journal_filename, csv_file):
+        """
+        Write the contents of a journal as CSV.
+
+        :param journal_filename: name of a journal written by a JournalCheckpoint
+        :type journal_filename: str
+        :param csv_file: file to write the CSV to
+        :type csv_file: file
+        :return: number of rows exported
+        :rtype: int
+        """
+        connection = sqlite3.connect(journal_filename)
+        try:
+            writer = csv.writer(csv_file, lineterminator="\n")
+            writer.writerow(cls.journal_columns(connection))
+            n = 0
+            for row in cls.rows(connection):
+                writer.writerow([DataFrameCheckpoint.csv_value(value) for value in row])
+                n += 1
+        finally:
+            connection.close()
+        return n
+
+
+def commit_filename(filename):
+    return filename + ".commit"
+
+
+def read_commit(filename):
+    """
+    Read the commit record of a checkpoint file.
+
+    :param filename: checkpoint file name
+    :type filename: str
+    :return: committed position of the file and the positions of its dependents, or None if there is no commit record
+    :rtype: dict
+    """
+    try:
+        with open(commit_filename(filename)) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def write_commit(filename, position, dependents):
+    """
+    Atomically replace the commit record of a checkpoint file.
+    """
+    temporary_filename = commit_filename(filename) + ".temp"
+    with open(temporary_filename, "w") as f:
+        json.dump({"position": position, "dependents": dependents}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_filename, commit_filename(filename))
+
+
+def recover_dependents(dependents, commit, new):
+    """
+    Truncate the dependents of a checkpoint to the positions committed with it.
+
+    If the checkpoint is new, nothing written to its dependents was committed with it.
+    """
+    for dependent in dependents:
+        if new:
+            dependent.truncate(0)
+        elif commit is not None and dependent.filename() in commit["dependents"]:
+            dependent.truncate(commit["dependents"][dependent.filename()])
+
+
+def remove_checkpoint(filename):
+    """
+    Remove a checkpoint file along with its commit record.
+    """
+    for name in [filename, commit_filename(filename)]:
+        if os.path.isfile(name):
+            os.remove(name)
+
 
 def retry(function, times):
     """
@@ -5,27 +5,33 @@ various Q&A systems, annotate the answers and analyze the results.
 
 import argparse
 import os
+import sys
 
 import pandas
 
 from themis import configure_logger, CsvFileType, to_csv, QUESTION, ANSWER_ID, pretty_print_json, logger, print_csv, \
-    __version__, FREQUENCY, ANSWER, IN_PURVIEW, CORRECT, DOCUMENT_ID, ensure_directory_exists
+    __version__, FREQUENCY, ANSWER, IN_PURVIEW, CORRECT, ensure_directory_exists, RANK
 from themis.analyze import SYSTEM, CollatedFileType, add_judgments_and_frequencies_to_qa_pairs, system_similarity, \
     compare_systems, oracle_combination, filter_judged_answers, corpus_statistics, truth_statistics, \
-    in_purview_disagreement, analyze_answers, truth_coverage, OracleFileType
-from themis.answer import answer_questions, Solr, get_answers_from_usage_log, AnswersFileType
-from themis.checkpoint import retry
+    in_purview_disagreement, analyze_answers, truth_coverage, OracleFileType, ranked_answers_accuracy, \
+    latency_percentiles
+from themis.answer import answer_questions, Solr, get_answers_from_usage_log, AnswersFileType, RankedAnswersFileType, \
+    LatencyFileType
+from themis.bm25 import BM25Index
+from themis.cache import AnswerCache, CachedSystem, CachedBatchSystem, ResponseCache
+from themis.checkpoint import retry, JournalCheckpoint, remove_checkpoint, Shard, shard_filename
 from themis.fixup import filter_usage_log_by_date, filter_usage_log_by_user_experience, deakin, filter_corpus
 from themis.judge import AnnotationAssistFileType, annotation_assist_qa_input, create_annotation_assist_corpus, \
     interpret_annotation_assist, JudgmentFileType, augment_usage_log
-from themis.nlc import train_nlc, NLC, classifier_list, classifier_status, remove_classifiers
+from themis.nlc import train_nlc, NLC, BatchNLC, classifier_list, classifier_status, remove_classifiers
 from themis.plot import generate_curves, plot_curves
 from themis.question import QAPairFileType, UsageLogFileType, extract_question_answer_pairs_from_usage_logs, \
     QuestionFrequencyFileType, DATE_TIME
-from themis.trec import corpus_from_trec
+from themis.throttle import RetryPolicy, Governor
+from themis.trec import write_corpus_from_trec
 from themis.xmgr import CorpusFileType, XmgrProject, DownloadCorpusFromXmgrClosure, download_truth_from_xmgr, \
     validate_truth_with_corpus, TruthFileType, examine_truth, validate_answers_with_corpus, augment_corpus_answers, \
-    augment_corpus_truth
+    augment_corpus_truth, HTTP_CACHE
 
 
 def main():
@@ -58,6 +64,18 @@ def xmgr_command(subparsers):
     xmgr_shared_arguments.add_argument("url", help="XMGR url")
     xmgr_shared_arguments.add_argument("username", help="XMGR username")
     xmgr_shared_arguments.add_argument("password", help="XMGR password")
+    xmgr_shared_arguments.add_argument("--attempts", metavar="ATTEMPTS", type=int, default=5,
+                                       help="number of times to attempt each request to XMGR, default 5")
+    xmgr_shared_arguments.add_argument("--pool-size", metavar="POOL-SIZE", type=int, default=10,
+                                       help="number of connections to XMGR to keep open for reuse, default 10")
+    xmgr_shared_arguments.add_argument("--http-cache", action="store_true",
+                                       help="cache XMGR responses in %s in the output directory " % HTTP_CACHE +
+                                            "and reuse them in later runs")
+    xmgr_shared_arguments.add_argument("--http-cache-ttl", metavar="SECONDS", type=float, default=86400,
+                                       help="use cached responses without revalidating them with XMGR for this long, " +
+                                            "default one day")
+    xmgr_shared_arguments.add_argument("--http-cache-size", metavar="MEGABYTES", type=int, default=1024,
+                                       help="maximum size of the compressed responses in the cache, default 1024")
 
     verify_arguments = argparse.ArgumentParser(add_help=False)
     verify_arguments.add_argument("corpus", type=CorpusFileType(),
@@ -68,28 +86,52 @@ def xmgr_command(subparsers):
     output_directory.add_argument("--output-directory", metavar="OUTPUT-DIRECTORY", type=str, default=".",
                                   help="output directory")
 
+    shard_argument = shard_arguments("documents")
+
     xmgr_parser = subparsers.add_parser("xmgr", help="download information from XMGR")
     subparsers = xmgr_parser.add_subparsers(description="download information from XMGR")
     # Download corpus from XMGR.
     xmgr_download = subparsers.add_parser("download-corpus",
-                                          parents=[xmgr_shared_arguments, output_directory], help="download corpus")
+                                          parents=[xmgr_shared_arguments, output_directory, shard_argument],
+                                          help="download corpus")
     xmgr_download.add_argument("--max-docs", metavar="MAX-DOCS", type=int,
                                help="maximum number of corpus documents to download")
     xmgr_download.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=10,
                                help="flush corpus to checkpoint file after downloading this many documents")
     xmgr_download.add_argument("--retries", type=int, help="number of times to retry downloading after an error")
+    xmgr_download.add_argument("--journal", action="store_true",
+                               help="save intermediate results in journals that can be recovered without rereading " +
+                                    "the downloaded corpus")
+    xmgr_download.add_argument("--workers", metavar="WORKERS", type=int,
+                               help="number of documents to download at once")
+    xmgr_download.add_argument("--pau-workers", metavar="PAU-WORKERS", type=int,
+                               help="number of PAUs in each document to download at once")
+    xmgr_download.add_argument("--sync", action="store_true",
+                               help="bring an existing corpus up to date by downloading only new and changed " +
+                                    "documents and dropping removed ones")
+    xmgr_download.add_argument("--max-memory", metavar="MEGABYTES", type=int, default=1024,
+                               help="approximate maximum amount of the corpus to hold in memory while sorting it, " +
+                                    "default 1024")
     xmgr_download.set_defaults(func=download_handler)
     # Get corpus from TREC documents directory.
-    xmgr_trec = subparsers.add_parser("trec-corpus", parents=[output_directory], help="extract corpus from TREC files")
+    xmgr_trec = subparsers.add_parser("trec-corpus", parents=[output_directory, shard_arguments("TREC files")],
+                                      help="extract corpus from TREC files")
     xmgr_trec.add_argument("directory", help="directory containing XML TREC files")
     xmgr_trec.add_argument("--max-docs", metavar="MAX-DOCS", type=int,
                            help="maximum number of TREC documents to examine")
     xmgr_trec.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=1000,
                            help="flush corpus to checkpoint file after parsing this many TREC files")
+    xmgr_trec.add_argument("--processes", "--workers", metavar="PROCESSES", dest="processes", type=int,
+                           help="number of processes parsing TREC files concurrently")
+    xmgr_trec.add_argument("--max-memory", metavar="MEGABYTES", type=int, default=1024,
+                           help="approximate maximum amount of the corpus to hold in memory while sorting it, " +
+                                "default 1024")
     xmgr_trec.set_defaults(func=trec_handler)
     # Download truth from XMGR.
     xmgr_truth = subparsers.add_parser("truth", parents=[xmgr_shared_arguments, output_directory],
                                        help="download truth file")
+    xmgr_truth.add_argument("--workers", metavar="WORKERS", type=int,
+                            help="number of pages of questions to download at once")
     xmgr_truth.set_defaults(func=truth_handler)
     # Download PAU ids corresponding to a document.
     xmgr_pau = subparsers.add_parser("pau-ids", parents=[xmgr_shared_arguments],
@@ -108,10 +150,13 @@ def xmgr_command(subparsers):
                                  help="question/answer pairs produced by the 'question extract' command")
     augment_answers.set_defaults(func=augment_answers_handler)
     # Augment corpus with answer IDs pulled from truth.
-    augment_truth = subparsers.add_parser("augment-truth", parents=[xmgr_shared_arguments, verify_arguments],
+    augment_truth = subparsers.add_parser("augment-truth",
+                                          parents=[xmgr_shared_arguments, verify_arguments, output_directory],
                                           help="augment corpus with answers from usage logs")
     augment_truth.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=10,
                                help="flush to checkpoint file after downloading this many answers")
+    augment_truth.add_argument("--workers", metavar="WORKERS", type=int,
+                               help="number of answers to download concurrently")
     augment_truth.set_defaults(func=augment_truth_handler)
     # Filter corpus.
     xmgr_filter = subparsers.add_parser("filter", help="fix up corpus")
@@ -138,32 +183,74 @@ def xmgr_command(subparsers):
     xmgr_examine.set_defaults(func=examine_handler)
 
 
+def shard_arguments(items):
+    shard_argument = argparse.ArgumentParser(add_help=False)
+    shard_argument.add_argument("--shard", metavar="i/N", type=Shard.parse,
+                                help="only process the %s in the ith of N shards, " % items +
+                                     "writing output to shard-specific files that can be combined with " +
+                                     "'util merge-shards'")
+    return shard_argument
+
+
+def xmgr_project(args):
+    concurrency = (getattr(args, "workers", None) or 1) * (getattr(args, "pau_workers", None) or 1)
+    cache = None
+    if args.http_cache:
+        # Commands that do not write files into an output directory keep the cache in the current directory.
+        output_directory = getattr(args, "output_directory", ".")
+        ensure_directory_exists(output_directory)
+        cache = ResponseCache(os.path.join(output_directory, HTTP_CACHE), args.http_cache_ttl,
+                              megabytes(args.http_cache_size))
+    return XmgrProject(args.url, args.username, args.password, retry_policy(args, concurrency),
+                       max(args.pool_size, concurrency), cache)
+
+
+def megabytes(n):
+    return n * 1024 * 1024 if n is not None else None
+
+
+def retry_policy(args, concurrency):
+    """
+    Retry policy for a command that makes at most the specified number of concurrent calls to a remote service.
+
+    If there may be more than one at a time they are governed so that the service is not overloaded.
+    """
+    governor = Governor(concurrency) if concurrency is not None and concurrency > 1 else None
+    return RetryPolicy(args.attempts, governor=governor)
+
+
 def download_handler(args):
-    xmgr = XmgrProject(args.url, args.username, args.password)
-    closure = DownloadCorpusFromXmgrClosure(xmgr, args.output_directory, args.checkpoint_frequency, args.max_docs)
+    xmgr = xmgr_project(args)
+    closure = DownloadCorpusFromXmgrClosure(xmgr, args.output_directory, args.checkpoint_frequency, args.max_docs,
+                                            args.journal, args.shard, args.workers, args.pau_workers, args.sync,
+                                            megabytes(args.max_memory))
     retry(closure, args.retries)
 
 
 def trec_handler(args):
-    checkpoint_filename = os.path.join(args.output_directory, "corpus.trec.temp.csv")
-    corpus = corpus_from_trec(checkpoint_filename, args.directory, args.checkpoint_frequency, args.max_docs)
-    to_csv(os.path.join(args.output_directory, "corpus.csv"), CorpusFileType.output_format(corpus))
-    logger.info("%d documents and %d PAUs in corpus" % (len(corpus[DOCUMENT_ID].drop_duplicates()), len(corpus)))
-    os.remove(checkpoint_filename)
+    def output_filename(filename, sidecar=None):
+        return os.path.join(args.output_directory, shard_filename(filename, args.shard, sidecar))
+
+    checkpoint_filename = output_filename("corpus.csv", "trec.temp")
+    documents, paus = write_corpus_from_trec(output_filename("corpus.csv"), checkpoint_filename, args.directory,
+                                             args.checkpoint_frequency, args.max_docs, args.processes, args.shard,
+                                             megabytes(args.max_memory), output_filename("corpus.csv", "trec-manifest"))
+    logger.info("%d documents and %d PAUs in corpus" % (documents, paus))
+    remove_checkpoint(checkpoint_filename)
 
 
 def truth_handler(args):
-    xmgr = XmgrProject(args.url, args.username, args.password)
-    download_truth_from_xmgr(xmgr, args.output_directory)
+    xmgr = xmgr_project(args)
+    download_truth_from_xmgr(xmgr, args.output_directory, args.workers)
 
 
 def pau_handler(args):
-    xmgr = XmgrProject(args.url, args.username, args.password)
+    xmgr = xmgr_project(args)
     print(pretty_print_json(xmgr.get_paus(args.pau)))
 
 
 def document_handler(args):
-    xmgr = XmgrProject(args.url, args.username, args.password)
+    xmgr = xmgr_project(args)
     print(", ".join(xmgr.get_pau_ids_in_document(args.document)))
 
 
@@ -173,8 +260,9 @@ def augment_answers_handler(args):
 
 
 def augment_truth_handler(args):
-    xmgr = XmgrProject(args.url, args.username, args.password)
-    augmented_corpus = augment_corpus_truth(xmgr, args.corpus, args.truth, args.checkpoint_frequency)
+    xmgr = xmgr_project(args)
+    augmented_corpus = augment_corpus_truth(xmgr, args.corpus, args.truth, args.checkpoint_frequency, args.workers,
+                                            args.output_directory)
     print_csv(CorpusFileType.output_format(augmented_corpus))
 
 
@@ -255,6 +343,11 @@ def answer_command(subparsers):
     Solr
         Lookup answers from a Solr database using questions as queries.
 
+    Local
+        Lookup answers in a BM25 index of the corpus built and searched in-process.
+        1. index
+        2. use
+
     NLC
         Train an NLC model to answer questions using the truth file downloaded from XMGR.
         1. train
@@ -272,6 +365,26 @@ def answer_command(subparsers):
     checkpoint_argument = argparse.ArgumentParser(add_help=False)
     checkpoint_argument.add_argument("--checkpoint-frequency", metavar="CHECKPOINT-FREQUENCY", type=int, default=100,
                                      help="how often to flush to a checkpoint file")
+    checkpoint_argument.add_argument("--concurrency", metavar="CONCURRENCY", type=int,
+                                     help="maximum number of questions to ask at once, fewer if the system is " +
+                                          "overloaded")
+    checkpoint_argument.add_argument("--cache", metavar="CACHE",
+                                     help="look up answers in this cache file before asking the system, " +
+                                          "and add new answers to it")
+    checkpoint_argument.add_argument("--cache-size", metavar="CACHE-SIZE", type=int,
+                                     help="maximum number of answers to keep in the cache")
+    checkpoint_argument.add_argument("--shard", metavar="i/N", type=Shard.parse,
+                                     help="only ask the questions in the ith of N shards, " +
+                                          "writing answers to a shard-specific output file that can be combined " +
+                                          "with others using 'util merge-shards'")
+    checkpoint_argument.add_argument("--top-k", metavar="K", type=int,
+                                     help="write the IDs and confidences of the K best answers to each question " +
+                                          "instead of the text of the best one")
+
+    # Options for systems that are asked questions over the network.
+    remote_argument = argparse.ArgumentParser(add_help=False)
+    remote_argument.add_argument("--attempts", metavar="ATTEMPTS", type=int, default=5,
+                                 help="number of times to attempt to ask each question, default 5")
 
     answer_parser = subparsers.add_parser("answer", help="answer questions with Q&A systems")
     subparsers = answer_parser.add_subparsers(description="answer questions with Q&A systems", help="Q&A systems")
@@ -283,11 +396,27 @@ def answer_command(subparsers):
     answer_wea.set_defaults(func=wea_handler)
 
     # Query answers from a Solr database.
-    answer_solr = subparsers.add_parser("solr", parents=[qa_shared_arguments, checkpoint_argument],
+    answer_solr = subparsers.add_parser("solr", parents=[qa_shared_arguments, checkpoint_argument, remote_argument],
                                         help="query answers from a Solr database")
     answer_solr.add_argument("url", type=str, help="solr URL")
     answer_solr.set_defaults(func=solr_handler)
 
+    # Answer questions with an in-process BM25 index.
+    local_parser = subparsers.add_parser("local", help="answer questions with a BM25 index of the corpus")
+    local_subparsers = local_parser.add_subparsers(title="BM25", description="build and use BM25 indexes",
+                                                   help="BM25 actions")
+    local_index = local_subparsers.add_parser("index", help="build a BM25 index of the answers in a corpus")
+    local_index.add_argument("corpus", type=CorpusFileType(),
+                             help="corpus file created by the 'download-corpus' or 'trec-corpus' command")
+    local_index.add_argument("index", help="directory in which to save the index")
+    local_index.add_argument("--k1", type=float, default=1.2, help="BM25 term frequency saturation, default 1.2")
+    local_index.add_argument("--b", type=float, default=0.75, help="BM25 document length normalization, default 0.75")
+    local_index.set_defaults(func=local_index_handler)
+    local_use = local_subparsers.add_parser("use", parents=[qa_shared_arguments, checkpoint_argument],
+                                            help="use a BM25 index")
+    local_use.add_argument("index", help="directory created by the 'answer local index' command")
+    local_use.set_defaults(func=local_use_handler)
+
     # Manage an NLC model.
     nlc_shared_arguments = argparse.ArgumentParser(add_help=False)
     nlc_shared_arguments.add_argument("url", help="NLC url")
@@ -303,11 +432,15 @@ def answer_command(subparsers):
     nlc_train.add_argument("name", help="classifier name")
     nlc_train.set_defaults(func=nlc_train_handler)
     # Use an NLC model.
-    nlc_use = nlc_subparsers.add_parser("use", parents=[nlc_shared_arguments, qa_shared_arguments, checkpoint_argument],
+    nlc_use = nlc_subparsers.add_parser("use", parents=[nlc_shared_arguments, qa_shared_arguments, checkpoint_argument,
+                                                        remote_argument],
                                         help="use NLC model")
     nlc_use.add_argument("classifier", help="classifier id")
     nlc_use.add_argument("corpus", type=CorpusFileType(),
                          help="corpus file created by the 'download-corpus' or 'trec-corpus' command")
+    nlc_use.add_argument("--batch", action="store_true",
+                         help="classify questions in batches, with concurrent requests if the classifier cannot " +
+                              "classify collections")
     nlc_use.set_defaults(func=nlc_use_handler)
     # List all NLC models.
     nlc_list = nlc_subparsers.add_parser("list", parents=[nlc_shared_arguments], help="list NLC models")
@@ -328,7 +461,16 @@ def wea_handler(args):
 
 
 def solr_handler(args):
-    answer_questions(Solr(args.url), set(args.questions[QUESTION]), args.output, args.checkpoint_frequency)
+    solr = Solr(args.url, retry_policy(args, args.concurrency))
+    answer_questions_handler(solr, args)
+
+
+def local_index_handler(args):
+    BM25Index.build(args.corpus, args.k1, args.b).save(args.index)
+
+
+def local_use_handler(args):
+    answer_questions_handler(BM25Index.load(args.index), args)
 
 
 def nlc_train_handler(args):
@@ -337,8 +479,35 @@ def nlc_train_handler(args):
 
 def nlc_use_handler(args):
     corpus = args.corpus.set_index(ANSWER_ID)
-    n = NLC(args.url, args.username, args.password, args.classifier, corpus)
-    answer_questions(n, set(args.questions[QUESTION]), args.output, args.checkpoint_frequency)
+    if args.batch:
+        policy = retry_policy(args, (args.concurrency or 1) * BatchNLC.WORKERS)
+        n = BatchNLC(args.url, args.username, args.password, args.classifier, corpus, policy)
+    else:
+        n = NLC(args.url, args.username, args.password, args.classifier, corpus, retry_policy(args, args.concurrency))
+    answer_questions_handler(n, args)
+
+
+def answer_questions_handler(system, args):
+    if args.cache is not None and args.top_k is not None:
+        raise ValueError("Ranked answers are not cached, so --cache cannot be used with --top-k")
+    if args.cache is not None:
+        cache = AnswerCache(args.cache, args.cache_size)
+        system = (CachedBatchSystem if hasattr(system, "ask_batch") else CachedSystem)(system, cache)
+    try:
+        answer_questions(system, questions_to_ask(args), shard_filename(args.output, args.shard),
+                         args.checkpoint_frequency, args.concurrency, args.top_k)
+    finally:
+        if args.cache is not None:
+            logger.info("%d answers from cache, %d from %s" % (system.hits, system.misses, system.system))
+            cache.close()
+
+
+def questions_to_ask(args):
+    questions = set(args.questions[QUESTION])
+    if args.shard is not None:
+        questions = set(args.shard.select(questions))
+        logger.info("%d questions in shard %s" % (len(questions), args.shard))
+    return questions
 
 
 def nlc_list_handler(args):
@@ -553,6 +722,23 @@ def analyze_command(parser, subparsers):
     purview_disagreement_parser.add_argument("collated", type=CollatedFileType(),
                                              help="combined system answers and judgments created by 'analyze collate'")
     purview_disagreement_parser.set_defaults(func=purview_disagreement_handler)
+    # Recall and mean reciprocal rank of ranked answers.
+    ranked_parser = subparsers.add_parser("ranked", help="recall at k and mean reciprocal rank of ranked answers")
+    ranked_parser.add_argument("truth", type=TruthFileType(), help="truth file created by the 'xmgr truth' command")
+    ranked_parser.add_argument("answers", type=RankedAnswersFileType(), nargs="+",
+                               help="ranked answers created by an 'answer' command run with --top-k")
+    ranked_parser.add_argument("--labels", nargs="+", help="names of the Q&A systems")
+    ranked_parser.add_argument("--k", metavar="K", type=int, nargs="+", default=[1, 5, 10],
+                               help="ranks at which to measure recall, default 1 5 10")
+    ranked_parser.set_defaults(func=HandlerClosure(ranked_handler, parser))
+    # Latency percentiles.
+    latency_parser = subparsers.add_parser("latency", help="percentiles of the time systems took to answer questions")
+    latency_parser.add_argument("answers", metavar="latency", type=LatencyFileType(), nargs="+",
+                                help="latency files written next to the answers by an 'answer' command")
+    latency_parser.add_argument("--labels", nargs="+", help="names of the Q&A systems")
+    latency_parser.add_argument("--window", help="break the percentiles down into windows of this length of time, " +
+                                                 "e.g. 10min")
+    latency_parser.set_defaults(func=HandlerClosure(latency_handler, parser))
 
 
 # noinspection PyTypeChecker
@@ -675,6 +861,16 @@ def purview_disagreement_handler(args):
     print_csv(CollatedFileType.output_format(purview_disagreement))
 
 
+def ranked_handler(parser, args):
+    accuracy = ranked_answers_accuracy(answer_labels(parser, args), args.truth, args.k)
+    print_csv(accuracy)
+
+
+def latency_handler(parser, args):
+    percentiles = latency_percentiles(answer_labels(parser, args), args.window)
+    print_csv(percentiles)
+
+
 def util_command(subparsers):
     util_parser = subparsers.add_parser("util", help="various utilities")
     subparsers = util_parser.add_subparsers(description="various utilities")
@@ -684,6 +880,25 @@ def util_command(subparsers):
     drop_null = subparsers.add_parser("drop-null", help="drop rows that contain null values from a CSV file")
     drop_null.add_argument("file", type=CsvFileType(), help="CSV file")
     drop_null.set_defaults(func=drop_null_handler)
+    export_journal = subparsers.add_parser("export-journal", help="write a checkpoint journal as a CSV file")
+    export_journal.add_argument("journal", help="journal created by a command run with the --journal option")
+    export_journal.set_defaults(func=export_journal_handler)
+    merge_shards = subparsers.add_parser("merge-shards", help="combine the output of commands run with --shard")
+    merge_shards.add_argument("type", choices=["answers", "ranked", "corpus"], help="type of file")
+    # Read every value as a string so that the merged file has the same values as the shards.
+    merge_shards.add_argument("shards", nargs="+", type=CsvFileType(dtype=str),
+                              help="answers, ranked answers, or corpus files written by commands run with --shard")
+    merge_shards.set_defaults(func=merge_shards_handler)
+    cache = subparsers.add_parser("cache", help="manage answer caches")
+    cache_subparsers = cache.add_subparsers(description="manage answer caches")
+    cache_stats = cache_subparsers.add_parser("stats", help="number of cached answers for each system")
+    cache_stats.add_argument("cache", help="cache file created by an 'answer' command run with the --cache option")
+    cache_stats.set_defaults(func=cache_stats_handler)
+    cache_prune = cache_subparsers.add_parser("prune", help="evict the least recently used answers from a cache")
+    cache_prune.add_argument("cache", help="cache file created by an 'answer' command run with the --cache option")
+    cache_prune.add_argument("max_entries", metavar="max-entries", type=int, help="number of answers to keep")
+    cache_prune.add_argument("--system", help="only prune answers from this system, as listed by 'util cache stats'")
+    cache_prune.set_defaults(func=cache_prune_handler)
 
 
 def rows_handler(args):
@@ -700,6 +915,47 @@ def drop_null_handler(args):
     print_csv(non_null, index=False)
 
 
+def export_journal_handler(args):
+    n = JournalCheckpoint.export(args.journal, sys.stdout)
+    logger.info("Exported %d rows from %s" % (n, args.journal))
+
+
+def merge_shards_handler(args):
+    merged = pandas.concat(args.shards)
+    if args.type == "answers":
+        merged = merged[AnswersFileType.columns].drop_duplicates(QUESTION)
+        print_csv(merged.sort_values(QUESTION).set_index(QUESTION))
+    elif args.type == "ranked":
+        merged = merged[RankedAnswersFileType.columns].drop_duplicates([QUESTION, RANK])
+        # The shards are read as strings, so sort ranks as numbers. A question with no answers has no rank.
+        merged = merged.assign(order=pandas.to_numeric(merged[RANK])).sort_values([QUESTION, "order"])
+        print_csv(merged.drop("order", axis="columns").set_index(QUESTION))
+    else:
+        print_csv(CorpusFileType.output_format(merged.drop_duplicates(ANSWER_ID)))
+    logger.info("Merged %d %s from %d shards" % (len(merged), args.type, len(args.shards)))
+
+
+def cache_stats_handler(args):
+    cache = AnswerCache(args.cache)
+    try:
+        stats = pandas.DataFrame(cache.stats(),
+                                 columns=[SYSTEM, "Answers", "Least Recently Used", "Most Recently Used"])
+    finally:
+        cache.close()
+    for column in ["Least Recently Used", "Most Recently Used"]:
+        stats[column] = pandas.to_datetime(stats[column], unit="s")
+    print_csv(stats.set_index(SYSTEM))
+
+
+def cache_prune_handler(args):
+    cache = AnswerCache(args.cache)
+    try:
+        n = cache.prune(args.max_entries, args.system)
+    finally:
+        cache.close()
+    logger.info("Evicted %d answers from %s" % (n, args.cache))
+
+
 def version_command(subparsers):
     version_parser = subparsers.add_parser("version", help="print version number")
     version_parser.set_defaults(func=version_handler)
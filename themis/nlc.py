@@ -1,9 +1,12 @@
+import json
 import tempfile
 
 from watson_developer_cloud import NaturalLanguageClassifierV1 as NaturalLanguageClassifier
 
 from themis import QUESTION, ANSWER_ID, ANSWER
 from themis import logger, to_csv, pretty_print_json
+from themis.checkpoint import map_items
+from themis.throttle import RetryPolicy, host_name, http_status, call_statistics
 
 
 def classifier_list(url, username, password):
@@ -43,16 +46,93 @@ class NLC(object):
     `Watson developer cloud Python SDK <https://github.com/watson-developer-cloud/python-sdk>`.
     """
 
-    def __init__(self, url, username, password, classifier_id, corpus):
+    def __init__(self, url, username, password, classifier_id, corpus, retry_policy=None):
         self.nlc = NaturalLanguageClassifier(url=url, username=username, password=password)
+        self.host = host_name(url)
         self.classifier_id = classifier_id
-        self.corpus = corpus
+        # Class names are the answer IDs the classifier was trained on, as strings.
+        self.answers = dict(zip(corpus.index.astype(str), corpus[ANSWER]))
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
 
     def __repr__(self):
         return "NLC: %s" % self.classifier_id
 
+    def fingerprint(self):
+        return "NLC %s" % self.classifier_id
+
     def ask(self, question):
-        classification = self.nlc.classify(self.classifier_id, question)
-        class_name = classification["classes"][0]["class_name"]
-        confidence = classification["classes"][0]["confidence"]
-        return self.corpus.loc[class_name][ANSWER], confidence
+        class_name, confidence = self.classify(question)[0]
+        return self.answers[class_name], confidence
+
+    def ask_top_k(self, question, k):
+        """
+        :return: answer IDs and confidences of the k best answers, best first
+        :rtype: list of (str, float)
+        """
+        return self.classify(question)[:k]
+
+    def classify(self, question):
+        classification = self.retry_policy.call(self.host, self.nlc.classify, self.classifier_id, question)
+        # The SDK does not expose the response body, so measure its JSON encoding instead.
+        call_statistics.bytes += len(json.dumps(classification))
+        return [(c["class_name"], c["confidence"]) for c in classification["classes"]]
+
+
+class BatchNLC(NLC):
+    """
+    Natural Language Classifier that classifies batches of questions.
+
+    Questions are sent to the classify_collection endpoint in groups of up to 30, the most it accepts in one request. If
+    the service says it does not have that endpoint, questions are instead classified by concurrent classify requests
+    for the rest of the run.
+    """
+    COLLECTION_SIZE = 30
+    WORKERS = 10
+    # HTTP statuses with which a service that does not have the classify_collection endpoint rejects requests to it
+    UNSUPPORTED = (404, 405, 501)
+
+    def __init__(self, url, username, password, classifier_id, corpus, retry_policy=None, workers=WORKERS):
+        super(BatchNLC, self).__init__(url, username, password, classifier_id, corpus, retry_policy)
+        self.workers = workers
+        self.collection = True
+
+    def ask_batch(self, questions):
+        return [(self.answers[classes[0][0]], classes[0][1]) for classes in self.classify_batch(questions)]
+
+    def ask_top_k_batch(self, questions, k):
+        return [classes[:k] for classes in self.classify_batch(questions)]
+
+    def classify_batch(self, questions):
+        classifications = []
+        for i in range(0, len(questions), self.COLLECTION_SIZE):
+            group = questions[i:i + self.COLLECTION_SIZE]
+            if self.collection:
+                try:
+                    classifications.extend(self.retry_policy.call(self.host, self.classify_collection, group))
+                    continue
+                except Exception as e:
+                    # Any other failure, including one that is still transient after the retries, fails the batch so
+                    # that it is asked again by a later run.
+                    if http_status(e) not in self.UNSUPPORTED:
+                        raise
+                    logger.warning("Cannot classify collection with %s, classify questions individually: %s" %
+                                   (self.classifier_id, e))
+                    self.collection = False
+            # The questions are classified on other threads, so bring their call statistics back to this one.
+            for _, (classes, retries, size) in map_items(self.counted_classify, group, self.workers):
+                classifications.append(classes)
+                call_statistics.retries += retries
+                call_statistics.bytes += size
+        return classifications
+
+    def counted_classify(self, question):
+        call_statistics.reset()
+        classes = self.classify(question)
+        return classes, call_statistics.retries, call_statistics.bytes
+
+    def classify_collection(self, questions):
+        r = self.nlc.request(method="POST", url="/v1/classifiers/%s/classify_collection" % self.classifier_id,
+                             accept_json=True, json={"collection": [{"text": question} for question in questions]})
+        call_statistics.bytes += len(json.dumps(r))
+        return [[(c["class_name"], c["confidence"]) for c in classification["classes"]]
+                for classification in r["collection"]]
@@ -0,0 +1,288 @@
+"""
+Make calls to remote services robust to transient failures.
+
+Individual calls are retried with exponential backoff and jitter. Failures are tracked per host by a circuit breaker so
+that when a host is down all the threads calling it pause instead of each one hammering it with retries. The number of
+concurrent calls to each host may be adjusted to the load it can bear by a governor.
+"""
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+from themis import logger
+
+
+def host_name(url):
+    return urlparse(url).netloc
+
+
+def is_transient(e):
+    """
+    Is this error one that might go away if the call is retried?
+
+    HTTP errors with status 429 (too many requests) or 5xx are transient, other HTTP errors are not. Network errors are
+    transient.
+
+    :param e: error raised by a call to a remote service
+    :type e: Exception
+    :return: whether the call should be retried
+    :rtype: bool
+    """
+    status = http_status(e)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, (IOError, OSError))
+
+
+# The Watson developer cloud SDK only reports the status code of a failed request in the message of the exception it
+# raises, e.g. "Error: Too many requests, Code: 429".
+WATSON_STATUS = re.compile(r"\bCode: (\d{3})\b")
+
+
+def http_status(e):
+    """
+    HTTP status code associated with an error raised by one of the client libraries, or None if there is not one.
+
+    >>> from watson_developer_cloud import WatsonException
+    >>> http_status(WatsonException("Error: Too many requests, Code: 429"))
+    429
+    """
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        # solrpy puts the status code on the exception itself, as do versions of the Watson developer cloud SDK newer
+        # than the one this uses.
+        status = getattr(e, "httpcode", None) or getattr(e, "code", None)
+    if status is None and type(e).__module__.startswith("watson_developer_cloud"):
+        match = WATSON_STATUS.search(str(e))
+        if match is not None:
+            status = match.group(1)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class CallStatistics(threading.local):
+    """
+    Retries made and bytes received by the calls to remote services made by the current thread since the last reset
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.retries = 0
+        self.bytes = 0
+
+
+call_statistics = CallStatistics()
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker.
+
+    After a host has failed a specified number of times in a row its circuit opens and callers wait until a cool-down
+    period has passed. Then a single trial call is let through. If it succeeds the circuit closes, otherwise it opens
+    again for another cool-down period.
+    """
+
+    def __init__(self, threshold=5, cool_down=30.0):
+        self.threshold = threshold
+        self.cool_down = cool_down
+        self.lock = threading.Condition()
+        self.failures = {}
+        self.opened = {}
+        self.trial = set()
+
+    def __repr__(self):
+        return "%s: threshold %d, cool down %0.1fs" % (self.__class__.__name__, self.threshold, self.cool_down)
+
+    def wait(self, host):
+        """
+        Block until a call to the host is allowed.
+        """
+        with self.lock:
+            while True:
+                opened = self.opened.get(host)
+                if opened is None:
+                    return
+                remaining = opened + self.cool_down - time.time()
+                if remaining <= 0 and host not in self.trial:
+                    self.trial.add(host)
+                    return
+                self.lock.wait(remaining if remaining > 0 else self.cool_down)
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            if self.opened.pop(host, None) is not None:
+                logger.info("Circuit to %s closed" % host)
+            self.trial.discard(host)
+            self.lock.notify_all()
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if host in self.trial or (host not in self.opened and self.failures[host] >= self.threshold):
+                logger.warning("Circuit to %s opened after %d failures" % (host, self.failures[host]))
+                self.opened[host] = time.time()
+            self.trial.discard(host)
+            self.lock.notify_all()
+
+
+class Governor(object):
+    """
+    Adaptive per-host limit on the number of concurrent calls.
+
+    The limit is adjusted additive-increase/multiplicative-decrease style, like a TCP congestion window. It starts at
+    one call and doubles every round trip until the host first shows signs of congestion, after which it grows by one
+    call every round trip. A call that fails with a transient error halves the limit, at most once per round trip. While
+    calls take more than latency_tolerance times as long as the fastest recent calls the limit stops growing.
+
+    The limit never exceeds max_concurrency, which should be the number of threads making calls. The current limit,
+    call rate and latency for each host are logged every report_interval seconds.
+    """
+
+    def __init__(self, max_concurrency, latency_tolerance=2.0, report_interval=30.0):
+        self.max_concurrency = max_concurrency
+        self.latency_tolerance = latency_tolerance
+        self.report_interval = report_interval
+        self.lock = threading.Condition()
+        self.hosts = {}
+
+    def __repr__(self):
+        return "%s: maximum %d concurrent calls" % (self.__class__.__name__, self.max_concurrency)
+
+    def acquire(self, host):
+        """
+        Block until another concurrent call to the host is allowed.
+
+        :return: time at which the call was allowed, to be passed to release
+        :rtype: float
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = HostState()
+            while state.in_flight >= int(state.limit):
+                self.lock.wait()
+            state.in_flight += 1
+            return time.time()
+
+    def release(self, host, start, congested):
+        """
+        Record the end of a call to the host.
+
+        :param host: host the call was made to
+        :type host: str
+        :param start: value returned by acquire
+        :type start: float
+        :param congested: did the call fail with a transient error?
+        :type congested: bool
+        """
+        now = time.time()
+        latency = now - start
+        with self.lock:
+            state = self.hosts[host]
+            state.in_flight -= 1
+            state.calls += 1
+            state.latency = latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+            # Let the fastest latency drift upwards so that it tracks the host's current baseline.
+            state.fastest = latency if state.fastest is None else min(latency, state.fastest * 1.01)
+            if congested:
+                # Only the first failure of calls that were in flight together counts.
+                if start > state.decreased:
+                    state.limit = max(1.0, state.limit / 2)
+                    state.slow_start = False
+                    state.decreased = now
+                    logger.debug("Congestion at %s, limit %0.1f concurrent calls" % (host, state.limit))
+            elif state.latency > self.latency_tolerance * state.fastest:
+                state.slow_start = False
+            else:
+                state.limit += 1.0 if state.slow_start else 1.0 / state.limit
+                state.limit = min(state.limit, float(self.max_concurrency))
+            if now - state.reported >= self.report_interval:
+                logger.info("%s: %d concurrent calls, %0.1f calls per second, %0.0f ms latency" %
+                            (host, int(state.limit), state.calls / (now - state.reported), 1000 * state.latency))
+                state.calls = 0
+                state.reported = now
+            self.lock.notify_all()
+
+
+class HostState(object):
+    def __init__(self):
+        self.limit = 1.0
+        self.in_flight = 0
+        self.slow_start = True
+        self.decreased = 0.0
+        self.latency = None
+        self.fastest = None
+        self.calls = 0
+        self.reported = time.time()
+
+
+class RetryPolicy(object):
+    """
+    Retry calls to a host that fail with a transient error.
+
+    Each call may be attempted a specified number of times. The delay before the nth retry is chosen at random from
+    between zero and initial_delay * 2^n seconds, capped at max_delay. Calls to the same host share a circuit breaker,
+    and optionally a governor that limits how many of them are made at once.
+    """
+
+    def __init__(self, attempts=5, initial_delay=1.0, max_delay=60.0, breaker=None, governor=None):
+        assert attempts > 0
+        self.attempts = attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.governor = governor
+
+    def __repr__(self):
+        return "%s: %d attempts, %s" % (self.__class__.__name__, self.attempts, self.breaker)
+
+    def call(self, host, function, *args, **kwargs):
+        """
+        Call a function that makes a request to a host, retrying it if it fails with a transient error.
+
+        :param host: host the function makes a request to
+        :type host: str
+        :param function: function to call
+        :type function: func
+        :return: the value returned by the function
+        :raise Exception: the last error raised by the function if all attempts failed or the error was not transient
+        """
+        attempt = 0
+        while True:
+            self.breaker.wait(host)
+            start = self.governor.acquire(host) if self.governor is not None else None
+            try:
+                value = function(*args, **kwargs)
+            except Exception as e:
+                transient = is_transient(e)
+                if self.governor is not None:
+                    self.governor.release(host, start, transient)
+                if transient:
+                    self.breaker.failure(host)
+                else:
+                    self.breaker.success(host)
+                attempt += 1
+                if not transient or attempt == self.attempts:
+                    raise
+                call_statistics.retries += 1
+                delay = self.delay(attempt)
+                logger.debug("Error %s from %s, retry %d of %d in %0.1fs" %
+                             (e, host, attempt, self.attempts - 1, delay))
+                time.sleep(delay)
+            else:
+                if self.governor is not None:
+                    self.governor.release(host, start, False)
+                self.breaker.success(host)
+                return value
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.initial_delay * 2 ** (attempt - 1)))
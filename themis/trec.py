@@ -3,35 +3,306 @@ Parse the TREC XML format file in which XMGR stores PAU information.
 
 This is for when we have file system access to the corpus instead of needing to download it.
 """
+import csv
 import glob
+import hashlib
+import html
+import io
+import mmap
 import os
+import re
+from operator import itemgetter
 
 from bs4 import BeautifulSoup
 
-from themis import logger, from_csv, ANSWER_ID, ANSWER, TITLE, FILENAME, DOCUMENT_ID
+from themis import logger, external_sort, ANSWER_ID, ANSWER, TITLE, FILENAME, DOCUMENT_ID
 from themis.checkpoint import DataFrameCheckpoint, get_items
-from themis.xmgr import CorpusFileType
+from themis.xmgr import CorpusFileType, write_corpus
 
 
-def corpus_from_trec(checkpoint_filename, trec_directory, checkpoint_frequency, max_docs):
-    trec_filenames = sorted(glob.glob(os.path.join(trec_directory, "*.xml")))[:max_docs]
-    checkpoint = get_items("TREC files",
-                           trec_filenames,
-                           TrecFileCheckpoint(checkpoint_filename, checkpoint_frequency),
-                           parse_trec_file,
-                           checkpoint_frequency)
+def write_corpus_from_trec(corpus_filename, checkpoint_filename, trec_directory, checkpoint_frequency, max_docs,
+                           processes=None, shard=None, max_memory=None, manifest_filename=None):
+    """
+    Extract a corpus from TREC files and write it to a corpus file without reading all of it into memory.
+
+    If a manifest file is given, the size, modification time, MD5 hash and answer ID of every TREC file are recorded in
+    it. When it and the corpus file already exist, the corpus is updated instead of being extracted again from scratch.
+    Only TREC files that are new or whose contents have changed since the manifest was written are parsed, and the
+    answers from TREC files that have been removed are dropped. Files whose size and modification time have not changed
+    are not read at all.
+
+    The updated corpus is the same as one extracted from scratch. Where several TREC files have the same answer ID
+    the corpus keeps the answer from the first of them, so unchanged files that share an answer ID with a new, changed
+    or removed file are parsed again too.
+
+    :param manifest_filename: name of the TREC file manifest, if None do not keep one
+    :type manifest_filename: str
+    :return: number of documents and answers in the corpus
+    :rtype: (int, int)
+    """
+    trec_filenames = list_trec_files(trec_directory, max_docs, shard)
+    previous = {}
+    if manifest_filename is not None and os.path.isfile(manifest_filename) and os.path.isfile(corpus_filename):
+        previous = read_trec_manifest(manifest_filename)
+    # The size, modification time, hash and answer ID of every TREC file. The first three are taken before the file is
+    # parsed so that it will be parsed again if it changes while this runs.
+    manifest = {}
+    changed = []
+    for trec_filename in trec_filenames:
+        name = os.path.basename(trec_filename)
+        stat = os.stat(trec_filename)
+        size, modified = str(stat.st_size), repr(stat.st_mtime)
+        entry = previous.get(name)
+        if entry is None or entry[:2] != (size, modified):
+            md5 = trec_file_hash(trec_filename) if manifest_filename is not None else None
+            if entry is None or entry[2] != md5:
+                changed.append(trec_filename)
+                entry = (size, modified, md5, None)
+            else:
+                entry = (size, modified) + entry[2:]
+        manifest[name] = entry
+    removed = [name for name in previous if name not in manifest]
+    if previous:
+        logger.info("%d unchanged, %d new or changed and %d removed TREC files in %s" %
+                    (len(trec_filenames) - len(changed), len(changed), len(removed), manifest_filename))
+    # Answers in the existing corpus that may have changed.
+    changed_names = set(os.path.basename(trec_filename) for trec_filename in changed)
+    stale = set(previous[name][3] for name in removed)
+    stale.update(previous[name][3] for name in changed_names if name in previous)
+    checkpoint = get_trec_files(checkpoint_filename, changed, checkpoint_frequency, processes)
+    for row in checkpoint.read_rows():
+        name = os.path.basename(row[0])
+        if name in changed_names:
+            manifest[name] = manifest[name][:3] + (row[1],)
+            stale.add(row[1])
+    stale.discard("")
+    for name in changed_names:
+        if manifest[name][3] is None:
+            manifest[name] = manifest[name][:3] + ("",)
+    reparsed = [trec_filename for trec_filename in trec_filenames
+                if os.path.basename(trec_filename) not in changed_names and
+                manifest[os.path.basename(trec_filename)][3] in stale]
+    parsed = changed_names.union(os.path.basename(trec_filename) for trec_filename in reparsed)
+    parsed_rows = checkpoint.read_rows()
+    if reparsed:
+        logger.info("Parse %d unchanged TREC files with the same answer IDs as changed ones" % len(reparsed))
+        checkpoint = get_trec_files(checkpoint_filename, changed + reparsed, checkpoint_frequency, processes)
+        # The checkpoint holds the changed files and then the reparsed ones, but the answer kept for a duplicate answer
+        # ID is the one from the first file in filename order.
+        parsed_rows = external_sort(checkpoint.read_rows(), key=itemgetter(0), run_size=None,
+                                    directory=os.path.dirname(os.path.abspath(corpus_filename)),
+                                    max_bytes=max_memory // 2 if max_memory is not None else None,
+                                    size=lambda row: sum(len(value) for value in row) + 400)
+    invalid = sum(1 for entry in manifest.values() if not entry[3])
+    if invalid:
+        logger.warning("%d of %d TREC files are invalid (%0.3f%%)" %
+                       (invalid, len(manifest), 100 * invalid / len(manifest)))
+
+    def rows():
+        if previous:
+            with io.open(corpus_filename, encoding="utf-8", newline="") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    if row[0] not in stale:
+                        yield row
+        # A checkpoint recovered from an interrupted run may hold files that have since been removed. Drop the TREC
+        # filename column.
+        for row in parsed_rows:
+            if os.path.basename(row[0]) in parsed:
+                yield row[1:]
+
+    corpus = write_corpus(rows(), corpus_filename, max_memory)
+    if manifest_filename is not None:
+        write_trec_manifest(manifest, manifest_filename)
+    return corpus
+
+
+TREC_MANIFEST_COLUMNS = ["TREC Filename", "Size", "Modified", "Hash", ANSWER_ID]
+
+
+def read_trec_manifest(manifest_filename):
+    """
+    :return: size, modification time, MD5 hash and answer ID of each TREC file, indexed by its base name, all strings
+    :rtype: dict of str to (str, str, str, str)
+    """
+    with io.open(manifest_filename, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return dict((row[0], tuple(row[1:])) for row in reader)
+
+
+def write_trec_manifest(manifest, manifest_filename):
+    with io.open(manifest_filename + ".temp", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(TREC_MANIFEST_COLUMNS)
+        for name in sorted(manifest):
+            writer.writerow((name,) + manifest[name])
+    os.replace(manifest_filename + ".temp", manifest_filename)
+
+
+def trec_file_hash(trec_filename):
+    md5 = hashlib.md5()
+    with open(trec_filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def parse_trec_files(checkpoint_filename, trec_directory, checkpoint_frequency, max_docs, processes=None, shard=None):
+    """
+    Parse the TREC files in a directory into a checkpoint.
+
+    :param checkpoint_filename: name of the checkpoint file
+    :type checkpoint_filename: str
+    :param trec_directory: directory containing TREC XML files
+    :type trec_directory: str
+    :param checkpoint_frequency: how often to flush the checkpoint
+    :type checkpoint_frequency: int
+    :param max_docs: maximum number of TREC files to parse, if None parse them all
+    :type max_docs: int
+    :param processes: number of processes parsing TREC files, if None parse them in this process
+    :type processes: int
+    :param shard: only parse the TREC files in this shard
+    :type shard: Shard
+    :return: the checkpoint
+    :rtype: TrecFileCheckpoint
+    """
+    trec_filenames = list_trec_files(trec_directory, max_docs, shard)
+    checkpoint = get_trec_files(checkpoint_filename, trec_filenames, checkpoint_frequency, processes)
     if checkpoint.invalid:
         n = len(trec_filenames)
         logger.warning("%d of %d TREC files are invalid (%0.3f%%)" %
                        (checkpoint.invalid, n, 100 * checkpoint.invalid / n))
-    # I'm not sure why I'm getting duplicates after a restart.
-    return from_csv(checkpoint_filename).drop_duplicates().drop(TrecFileCheckpoint.TREC_FILENAME, axis="columns")
+    return checkpoint
+
+
+def list_trec_files(trec_directory, max_docs, shard=None):
+    trec_filenames = sorted(glob.glob(os.path.join(trec_directory, "*.xml")))[:max_docs]
+    if shard is not None:
+        # Hash the base names so that shards do not depend on where the TREC directory is.
+        trec_filenames = [trec_filename for trec_filename in trec_filenames if os.path.basename(trec_filename) in shard]
+        logger.info("%d TREC files in shard %s" % (len(trec_filenames), shard))
+    return trec_filenames
+
+
+def get_trec_files(checkpoint_filename, trec_filenames, checkpoint_frequency, processes=None):
+    """
+    Parse TREC files into a checkpoint.
+
+    Parsing is CPU-bound, so files may be parsed concurrently by a pool of processes. Filenames are sent to the
+    processes in chunks so that the cost of communicating with them does not outweigh the cost of parsing a file. The
+    parsed files are still written to the checkpoint in filename order.
+
+    :return: the checkpoint
+    :rtype: TrecFileCheckpoint
+    """
+    chunk_size = None
+    if processes is not None:
+        # Keep every process busy with several chunks, but send no more than 100 files at a time.
+        chunk_size = max(1, min(100, len(trec_filenames) // (4 * processes)))
+    return get_items("TREC files",
+                     trec_filenames,
+                     TrecFileCheckpoint(checkpoint_filename, checkpoint_frequency),
+                     parse_trec_file,
+                     checkpoint_frequency,
+                     processes,
+                     processes=True,
+                     chunk_size=chunk_size)
 
 
 def parse_trec_file(trec_filename):
     """
     Extract corpus fields from a TREC XML file.
 
+    Fields are scanned for with regular expressions, which is much faster than parsing the file, falling back to
+    parsing it with Beautiful Soup if they cannot all be found that way.
+
+    :param trec_filename: name of TREC XML file
+    :type trec_filename: str
+    :return: labeled fields extracted from the TREC file
+    :rtype: dict
+    """
+    trec = scan_trec_file(trec_filename)
+    if trec is None:
+        trec = soup_trec_file(trec_filename)
+    return trec
+
+
+# Tags containing the corpus fields.
+TREC_TAGS = [(ANSWER_ID, "meta:key:pautid"), (ANSWER, "text"), (TITLE, "title"),
+             (FILENAME, "meta:key:originalfile"), (DOCUMENT_ID, "meta:documentid")]
+
+
+def tag_pattern(tag):
+    tag = re.escape(tag).encode("ascii")
+    return re.compile(br"<" + tag + br"(?:\s[^>]*)?>(.*?)</" + tag + br"\s*>", re.IGNORECASE | re.DOTALL)
+
+
+TREC_FIELDS = [(field, tag_pattern(tag)) for field, tag in TREC_TAGS]
+
+
+def scan_trec_file(trec_filename):
+    """
+    Extract corpus fields from a TREC XML file by scanning a memory map of it for the tags that contain them.
+
+    This gives the same fields as soup_trec_file for the files it can handle: those without comments or CDATA sections
+    in which every tag appears, is closed, and contains text with no markup or NUL characters that is not all
+    whitespace, possibly with character references. It returns None for other files.
+
+    :param trec_filename: name of TREC XML file
+    :type trec_filename: str
+    :return: labeled fields extracted from the TREC file, or None if they cannot be extracted this way
+    :rtype: dict
+    """
+    with open(trec_filename, "rb") as trec_file:
+        if not os.fstat(trec_file.fileno()).st_size:
+            return None
+        trec = mmap.mmap(trec_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Tags inside comments and CDATA sections are not tags to Beautiful Soup, but would be matched here.
+            if trec.find(b"<!--") != -1 or trec.find(b"<![CDATA[") != -1:
+                return None
+            fields = {}
+            for field, pattern in TREC_FIELDS:
+                match = pattern.search(trec)
+                # Leave markup and NUL characters, which the HTML parser replaces, to Beautiful Soup.
+                if match is None or b"<" in match.group(1) or b"\0" in match.group(1):
+                    return None
+                # Translate newlines the way reading the file in text mode does.
+                text = match.group(1).decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+                text = unescape(text)
+                # The HTML parser collapses text that is all whitespace.
+                if not text.strip():
+                    return None
+                fields[field] = text
+            return fields
+        except UnicodeDecodeError:
+            return None
+        finally:
+            trec.close()
+
+
+def unescape(text):
+    """
+    Replace character references with the characters they refer to, as html.unescape does.
+
+    Escaped HTML is full of the same few references, which are much faster to replace one at a time than with
+    html.unescape.
+    """
+    references = [("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&amp;", "&")]
+    if text.count("&") != sum(text.count(reference) for reference, _ in references):
+        return html.unescape(text)
+    # Replace &amp; last so that the references it escapes are not replaced as well.
+    for reference, character in references:
+        text = text.replace(reference, character)
+    return text
+
+
+def soup_trec_file(trec_filename):
+    """
+    Extract corpus fields from a TREC XML file with Beautiful Soup.
+
     The TREC files may be mal-formed XML. (For instance they contain disallowed '&', '<', and '>' characters inside
     text, so parse them with the robust Beautiful Soup package, returning None if the file cannot be successfully
     parsed.
@@ -1,18 +1,31 @@
 """Utilities to download information from an Watson Experience Manager (XMGR) project"""
+import csv
+import functools
+import hashlib
+import io
+import itertools
 import json
 import os
+import re
+from operator import itemgetter
 
 import pandas
 import requests
 
 from themis import QUESTION, ANSWER_ID, ANSWER, TITLE, FILENAME, QUESTION_ID, from_csv, DOCUMENT_ID, CONFIDENCE, \
     FREQUENCY
-from themis import logger, to_csv, ensure_directory_exists, percent_complete_message, CsvFileType
-from themis.checkpoint import DataFrameCheckpoint, get_items
+from themis import logger, to_csv, ensure_directory_exists, percent_complete_message, CsvFileType, external_sort
+from themis.checkpoint import DataFrameCheckpoint, JournalCheckpoint, get_items, dead_letter_checkpoint, dead_letters, \
+    shard_filename, map_items, CatchErrors
 from themis.question import QAPairFileType, USER_EXPERIENCE, DATE_TIME
+from themis.throttle import RetryPolicy, host_name, call_statistics
 
+STAMP = "Stamp"
+# Name of the response cache XmgrProject uses when caching is enabled from the command line.
+HTTP_CACHE = "xmgr.cache.db"
 
-def download_truth_from_xmgr(xmgr, output_directory):
+
+def download_truth_from_xmgr(xmgr, output_directory, workers=None):
     """
     Download truth from an XMGR project.
 
@@ -20,12 +33,15 @@ def download_truth_from_xmgr(xmgr, output_directory):
     to train an NLC model.
 
     This function creates two files in the output directory: a raw truth.json that contains all the information
-    downloaded from XMGR and a filtered truth.csv file.
+    downloaded from XMGR and a filtered truth.csv file. Pages of questions are written to truth.json as they are
+    downloaded.
 
     :param xmgr: connection to an XMGR project REST API
     :type xmgr: XmgrProject
     :param output_directory: directory in which to create truth.json and truth.csv
     :type output_directory: str
+    :param workers: number of pages of questions to download at once, if None download them one at a time
+    :type workers: int
     """
     ensure_directory_exists(output_directory)
     truth_json = os.path.join(output_directory, "truth.json")
@@ -35,49 +51,198 @@ def download_truth_from_xmgr(xmgr, output_directory):
         return
     if not os.path.isfile(truth_json):
         logger.info("Get questions from %s" % xmgr)
-        mapped_questions = [question for question in xmgr.get_questions() if not question["state"] == "REJECTED"]
-        with open(truth_json, "w") as f:
-            json.dump(mapped_questions, f, indent=2)
-    else:
-        with open(truth_json) as f:
-            mapped_questions = json.load(f)
+        write_questions(truth_json, xmgr.get_question_pages(workers=workers))
     logger.info("Build truth from questions")
-    truth = get_truth_from_mapped_questions(mapped_questions)
-    to_csv(truth_csv, TruthFileType.output_format(truth))
+    build_truth(truth_json, truth_csv)
 
 
-def get_truth_from_mapped_questions(mapped_questions):
-    def get_pau_mapping(question):
-        if "predefinedAnswerUnit" in question:
-            return question["predefinedAnswerUnit"]
-        elif "mappedQuestion" in question:
-            question_id = question["mappedQuestion"]["id"]
-            try:
-                mapped_question = questions[question_id]
-            except KeyError:
-                logger.warning("Question %s mapped to non-existent question %s" % (question["id"], question_id))
-                return None
-            return get_pau_mapping(mapped_question)
-        else:
-            return None
+def iterate_json_list(f, buffer_size=1 << 16):
+    """
+    Parse the elements of a JSON list one at a time, without reading the whole list into memory.
+
+    :param f: file containing a JSON list
+    :type f: file
+    :param buffer_size: number of characters to read at a time
+    :type buffer_size: int
+    :return: elements of the list
+    :rtype: iterator
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[\s,]*")
+    buffer = f.read(buffer_size)
+    i = whitespace.match(buffer).end()
+    if buffer[i:i + 1] != "[":
+        raise ValueError("%s is not a JSON list" % getattr(f, "name", f))
+    i += 1
+    eof = False
+    while True:
+        i = whitespace.match(buffer, i).end()
+        if buffer[i:i + 1] == "]":
+            return
+        try:
+            element, end = decoder.raw_decode(buffer, i)
+        except ValueError:
+            element, end = None, len(buffer)
+        # An element that runs to the end of the buffer may continue beyond it.
+        if end == len(buffer) and not eof:
+            more = f.read(max(buffer_size, len(buffer) - i))
+            eof = not more
+            buffer, i = buffer[i:] + more, 0
+            continue
+        if element is None:
+            raise ValueError("Invalid JSON in %s" % getattr(f, "name", f))
+        yield element
+        i = end
+
+
+def write_questions(filename, pages):
+    """
+    Write the questions that have not been rejected to a JSON list, one page at a time.
+
+    The file is written under a temporary name and renamed when it is complete, so that an interrupted download is not
+    mistaken for a complete one.
+
+    :param filename: name of the JSON file
+    :type filename: str
+    :param pages: pages of questions downloaded from XMGR
+    :type pages: iterator of list of dict
+    """
+    n = 0
+    with open(filename + ".temp", "w") as f:
+        f.write("[")
+        for page in pages:
+            for question in page:
+                if question["state"] == "REJECTED":
+                    continue
+                # Lay the list out the same way as json.dump(questions, f, indent=2).
+                f.write("%s\n  %s" % ("," if n else "", json.dumps(question, indent=2).replace("\n", "\n  ")))
+                n += 1
+        f.write("\n]" if n else "]")
+    os.replace(filename + ".temp", filename)
+    logger.debug("%d questions" % n)
+
+
+def build_truth(truth_json, truth_csv, chunk_size=100000):
+    """
+    Build truth.csv from the questions in truth.json.
+
+    The questions are read from truth.json one at a time, twice: first to resolve the answer IDs of all the questions,
+    then to write the ones that have answer IDs to truth.csv, sorted by question ID, chunk_size rows at a time. Only
+    the question IDs and answer IDs are held in memory, so truth sets much larger than memory can be built.
 
-    unmapped = 0
+    The file is written under a temporary name and renamed when it is complete.
+
+    :param truth_json: questions downloaded from XMGR
+    :type truth_json: str
+    :param truth_csv: name of the truth file to write
+    :type truth_csv: str
+    :param chunk_size: number of rows to hold in memory at once
+    :type chunk_size: int
+    """
+
+    def mapped_questions():
+        with open(truth_json) as f:
+            for question in iterate_json_list(f):
+                answer_id = answer_ids[question["id"]]
+                if answer_id is not None:
+                    yield question["id"], question["text"], answer_id
+
+    answer_ids = {}
+    mappings = {}
+    with open(truth_json) as f:
+        for question in iterate_json_list(f):
+            answer_ids[question["id"]], mapped_question_id = pau_mapping(question)
+            if mapped_question_id is not None:
+                mappings[question["id"]] = mapped_question_id
+    resolve_mapped_questions(answer_ids, mappings)
+    mapped = 0
+    columns = [QUESTION_ID, QUESTION, ANSWER_ID]
+    with open(truth_csv + ".temp", "w", encoding="utf-8") as f:
+        # Write the header even if no questions are mapped, so that the file can be read as truth.
+        pandas.DataFrame(columns=columns).to_csv(f, index=False)
+        rows = external_sort(mapped_questions(), key=lambda row: row[0], run_size=chunk_size,
+                             directory=os.path.dirname(os.path.abspath(truth_csv)))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            pandas.DataFrame(chunk, columns=columns).to_csv(f, header=False, index=False)
+            mapped += len(chunk)
+    os.replace(truth_csv + ".temp", truth_csv)
+    logger.info("%d mapped, %d unmapped" % (mapped, len(answer_ids) - mapped))
+
+
+def get_truth_from_mapped_questions(mapped_questions):
+    answer_ids = {}
+    mappings = {}
     # Index the questions by their question id so that mapped questions can be looked up.
     questions = dict([(question["id"], question) for question in mapped_questions])
     for question in questions.values():
-        question[ANSWER_ID] = get_pau_mapping(question)
-        if question[ANSWER_ID] is None:
-            unmapped += 1
-    questions = [q for q in questions.values() if q[ANSWER_ID] is not None]
+        answer_ids[question["id"]], mapped_question_id = pau_mapping(question)
+        if mapped_question_id is not None:
+            mappings[question["id"]] = mapped_question_id
+    resolve_mapped_questions(answer_ids, mappings)
+    questions = [q for q in questions.values() if answer_ids[q["id"]] is not None]
     question_ids = [q["id"] for q in questions]
     question_text = [q["text"] for q in questions]
-    answer_id = [q[ANSWER_ID] for q in questions]
+    answer_id = [answer_ids[q["id"]] for q in questions]
     truth = pandas.DataFrame.from_dict({QUESTION_ID: question_ids, QUESTION: question_text, ANSWER_ID: answer_id})
-    logger.info("%d mapped, %d unmapped" % (len(truth), unmapped))
+    logger.info("%d mapped, %d unmapped" % (len(truth), len(answer_ids) - len(truth)))
     return truth
 
 
-def download_corpus_from_xmgr(xmgr, output_directory, checkpoint_frequency, max_docs):
+def pau_mapping(question):
+    """
+    :return: the PAU a question is mapped to and the ID of the question it is mapped to, either or both of which may be
+             None
+    :rtype: (str, str)
+    """
+    if "predefinedAnswerUnit" in question:
+        return question["predefinedAnswerUnit"], None
+    elif "mappedQuestion" in question:
+        return None, question["mappedQuestion"]["id"]
+    else:
+        return None, None
+
+
+def resolve_mapped_questions(answer_ids, mappings):
+    """
+    Follow chains of questions mapped to other questions to the PAUs at their ends.
+
+    Each chain is walked once: every question along it is assigned the answer ID at its end, so later chains that run
+    into it stop there. A chain that ends at a question that does not exist, or that loops back on itself, leaves all
+    the questions along it without an answer ID.
+
+    :param answer_ids: answer ID of every question, or None for those not mapped directly to a PAU, updated in place
+    :type answer_ids: dict
+    :param mappings: the question ID to which each question mapped to another question is mapped, emptied as the chains
+                     are resolved
+    :type mappings: dict
+    """
+    for question_id in list(mappings):
+        path = []
+        on_path = set()
+        while question_id not in answer_ids or question_id in mappings:
+            if question_id in on_path:
+                logger.warning("Question %s is in a cycle of mapped questions" % question_id)
+                answer_id = None
+                break
+            if question_id not in answer_ids:
+                logger.warning("Question %s mapped to non-existent question %s" % (path[-1], question_id))
+                answer_id = None
+                break
+            path.append(question_id)
+            on_path.add(question_id)
+            question_id = mappings[question_id]
+        else:
+            answer_id = answer_ids[question_id]
+        for question_id in path:
+            answer_ids[question_id] = answer_id
+            del mappings[question_id]
+
+
+def download_corpus_from_xmgr(xmgr, output_directory, checkpoint_frequency, max_docs, journal=False, shard=None,
+                              workers=None, pau_workers=None, sync=False, max_memory=None):
     """
     Download the corpus from an XMGR project
 
@@ -87,6 +252,19 @@ def download_corpus_from_xmgr(xmgr, output_directory, checkpoint_frequency, max_
     This can take a long time to complete, so intermediate results are saved in the directory. If you restart an
     incomplete download it will pick up where it left off.
 
+    Several documents may be downloaded at once by a pool of workers, and within each document several PAUs may be
+    downloaded at once by another pool. Documents are written to the checkpoints in order regardless.
+
+    An existing corpus may be synchronized with XMGR instead of being downloaded again from scratch. Documents that are
+    new to XMGR are downloaded, documents that have been removed from it are dropped from the corpus, and documents
+    whose XMGR metadata has changed since they were downloaded are downloaded again. The metadata is recorded in a
+    corpus.documents.csv file next to the corpus every time it is downloaded. Without it changed documents cannot be
+    detected, so only new and removed ones are synchronized.
+
+    Documents that cannot be downloaded are listed in a document_ids.dead-letter.csv file in the directory and skipped.
+    If there are any, an exception is raised at the end and the intermediate results are kept so that a subsequent run
+    will try to download just those documents.
+
     :param xmgr: connection to an XMGR project REST API
     :type xmgr: XmgrProject
     :param output_directory: directory into which write the corpus.csv file
@@ -95,43 +273,251 @@ def download_corpus_from_xmgr(xmgr, output_directory, checkpoint_frequency, max_
     :type checkpoint_frequency: int
     :param max_docs: maximum number of corpus documents to download, if None, download them all
     :type max_docs: int
+    :param journal: save intermediate results in journals instead of CSV files
+    :type journal: bool
+    :param shard: only download the documents in this shard, writing them to shard-specific files
+    :type shard: Shard
+    :param workers: number of documents to download at once, if None download them one at a time
+    :type workers: int
+    :param pau_workers: number of PAUs in each document to download at once, if None download them one at a time
+    :type pau_workers: int
+    :param sync: synchronize an existing corpus with XMGR
+    :type sync: bool
+    :param max_memory: approximate maximum number of bytes of corpus to hold in memory when writing the corpus file, if
+                       None hold all of it
+    :type max_memory: int
     """
-    document_ids_csv = os.path.join(output_directory, "document_ids.csv")
-    corpus_csv = os.path.join(output_directory, "corpus.csv")
-    if os.path.isfile(corpus_csv) and not os.path.isfile(document_ids_csv):
-        logger.info("Corpus already downloaded")
-        return
+
+    def get_paus(document_id):
+        return xmgr.get_paus_from_document(document_id, pau_workers)
+
+    def output_filename(filename, sidecar=None):
+        return os.path.join(output_directory, shard_filename(filename, shard, sidecar))
+
+    corpus_csv = output_filename("corpus.csv")
+    previous_corpus_csv = output_filename("corpus.csv", "previous")
+    documents_csv = output_filename("corpus.csv", "documents")
+    dead_letter_csv = output_filename("document_ids.dead-letter.csv")
+    if journal:
+        checkpoint_type = JournalCheckpoint
+        document_ids_checkpoint = output_filename("document_ids.journal")
+        corpus_checkpoint = output_filename("corpus.journal")
+    else:
+        checkpoint_type = DataFrameCheckpoint
+        document_ids_checkpoint = output_filename("document_ids.csv")
+        corpus_checkpoint = corpus_csv
+    if os.path.isfile(corpus_csv) and not os.path.isfile(document_ids_checkpoint):
+        if not sync:
+            logger.info("Corpus already downloaded")
+            return
+        # Move the corpus out of the way of the checkpoints. It is only removed once the synchronized corpus is done.
+        os.replace(corpus_csv, previous_corpus_csv)
     logger.info("Download corpus from %s" % xmgr)
-    document_ids = sorted(set(document["id"] for document in xmgr.get_documents()))
+    stamps = dict((document["id"], document_stamp(document)) for document in xmgr.get_documents())
+    document_ids = sorted(stamps)
     document_ids = document_ids[:max_docs]
+    if shard is not None:
+        document_ids = shard.select(document_ids)
+        logger.info("%d documents in shard %s" % (len(document_ids), shard))
     n = len(document_ids)
-    downloaded_document_ids = DataFrameCheckpoint(document_ids_csv, [DOCUMENT_ID, "Paus"], checkpoint_frequency)
-    corpus = DataFrameCheckpoint(corpus_csv, CorpusFileType.columns)
+    # The corpus is committed along with the document IDs so that after a restart it contains exactly the PAUs from
+    # the recovered documents.
+    corpus = checkpoint_type(corpus_checkpoint, CorpusFileType.columns)
+    # The stamp of each document is recorded when it is downloaded, so that a document that changes later is
+    # downloaded again by the next synchronization.
+    downloaded_document_ids = checkpoint_type(document_ids_checkpoint, [DOCUMENT_ID, "Paus", STAMP],
+                                              checkpoint_frequency, dependents=[corpus])
+    failed_document_ids = dead_letter_checkpoint(dead_letter_csv, DOCUMENT_ID)
     try:
         if downloaded_document_ids.recovered:
             logger.info("Recovered %d documents from previous run" % len(downloaded_document_ids.recovered))
-        document_ids = sorted(set(document_ids) - downloaded_document_ids.recovered)
-        m = len(document_ids)
-        start = len(downloaded_document_ids.recovered) + 1
+        done = set(downloaded_document_ids.recovered)
+        if os.path.isfile(previous_corpus_csv):
+            done.update(keep_unchanged_documents(previous_corpus_csv, documents_csv, document_ids, stamps, corpus,
+                                                 downloaded_document_ids))
+        remaining = sorted(set(document_ids) - done)
+        m = len(remaining)
+        start = len(done) + 1
         if m:
-            for i, document_id in enumerate(document_ids, start):
+            for i, (document_id, (paus, error)) in enumerate(map_items(CatchErrors(get_paus), remaining, workers),
+                                                             start):
                 if i % checkpoint_frequency == 0 or i == start or i == m:
-                    corpus.flush()
                     logger.info(percent_complete_message("Get PAUs from document", i, n))
-                paus = xmgr.get_paus_from_document(document_id)
-                # The document id and number of PAUs are both integers. Cast them to strings, otherwise pandas will
-                # write them as floats.
+                if error is not None:
+                    logger.warning("Could not get PAUs from document %s: %s" % (document_id, error))
+                    failed_document_ids.write(document_id, str(error))
+                    continue
+                # Write the document id to the corpus as a string so that it is read back the same way regardless of
+                # the checkpoint type.
                 for pau in paus:
                     corpus.write(pau["id"], pau["responseMarkup"], pau["title"], pau["sourceName"], str(document_id))
-                downloaded_document_ids.write(str(document_id), str(len(paus)))
+                downloaded_document_ids.write(document_id, len(paus), stamps[document_id])
     finally:
         downloaded_document_ids.close()
         corpus.close()
-    corpus = from_csv(corpus_csv).drop_duplicates(ANSWER_ID)
-    to_csv(corpus_csv, CorpusFileType.output_format(corpus))
-    docs = len(from_csv(document_ids_csv))
-    os.remove(document_ids_csv)
-    logger.info("%d documents and %d PAUs in corpus" % (docs, len(corpus)))
+        failed_document_ids.close()
+    failed = dead_letters(failed_document_ids)
+    if failed:
+        raise Exception("Could not download %d documents, listed in %s. Run again to retry them." %
+                        (failed, dead_letter_csv))
+    failed_document_ids.remove()
+    downloaded = dict((row[0], row[2]) for row in downloaded_document_ids.read_rows())
+    docs = len(downloaded)
+    # The same PAU may appear in more than one document. The corpus file is replaced atomically so that it is either the
+    # complete checkpoint or the complete corpus.
+    _, paus = write_corpus(corpus.read_rows(), corpus_csv, max_memory)
+    if journal:
+        corpus.remove()
+    documents = pandas.DataFrame([(str(document_id), downloaded[str(document_id)]) for document_id in document_ids],
+                                 columns=[DOCUMENT_ID, STAMP])
+    to_csv(documents_csv + ".temp", documents.set_index(DOCUMENT_ID))
+    os.replace(documents_csv + ".temp", documents_csv)
+    downloaded_document_ids.remove()
+    if os.path.isfile(previous_corpus_csv):
+        os.remove(previous_corpus_csv)
+    logger.info("%d documents and %d PAUs in corpus" % (docs, paus))
+
+
+def document_stamp(document):
+    """
+    A value that changes when an XMGR document changes.
+
+    This is the document's modification time or version if XMGR reports one, otherwise a hash of all its metadata.
+
+    :param document: document metadata returned by XMGR
+    :type document: dict
+    :return: document stamp
+    :rtype: str
+    """
+    for key in ["lastModified", "lastModifiedDate", "modified", "modifiedDate", "dateModified", "updated", "version"]:
+        if document.get(key) is not None:
+            return "%s %s" % (key, document[key])
+    return hashlib.md5(json.dumps(document, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def keep_unchanged_documents(previous_corpus_csv, documents_csv, document_ids, stamps, corpus,
+                             downloaded_document_ids):
+    """
+    Copy the PAUs of the documents in a previously downloaded corpus that have not changed since into the checkpoints
+    of a corpus being downloaded, as if they had just been downloaded.
+
+    The previous corpus is read one row at a time with every value kept as a string, the way write_corpus wrote it, so
+    that it does not have to fit in memory and its PAUs are copied unchanged. It is sorted by document ID, so the PAUs
+    of each document are contiguous and the document is recorded as downloaded after its last PAU.
+
+    :param previous_corpus_csv: previously downloaded corpus
+    :type previous_corpus_csv: str
+    :param documents_csv: stamps of the documents in the previously downloaded corpus, if this file exists
+    :type documents_csv: str
+    :param document_ids: documents to download
+    :type document_ids: list
+    :param stamps: current stamp of each document
+    :type stamps: dict
+    :param corpus: corpus checkpoint
+    :type corpus: DataFrameCheckpoint or JournalCheckpoint
+    :param downloaded_document_ids: document ID checkpoint
+    :type downloaded_document_ids: DataFrameCheckpoint or JournalCheckpoint
+    :return: IDs of the unchanged documents
+    :rtype: set
+    """
+    if os.path.isfile(documents_csv):
+        with io.open(documents_csv, encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            previous_stamps = dict((row[0], row[1]) for row in reader)
+    else:
+        logger.warning("No %s, so changed documents cannot be detected" % documents_csv)
+        previous_stamps = {}
+    # Documents still to be downloaded, indexed by their IDs as strings.
+    remaining = dict((str(document_id), document_id) for document_id in document_ids
+                     if document_id not in downloaded_document_ids.recovered)
+    previous_document_ids = set()
+    unchanged = set()
+    changed = 0
+
+    def keep(document_id, paus):
+        downloaded_document_ids.write(document_id, paus, stamps[document_id])
+        unchanged.add(document_id)
+
+    # The unchanged document whose PAUs are being copied and the number copied so far.
+    kept = None
+    with io.open(previous_corpus_csv, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if kept is not None and row[4] != str(kept[0]):
+                keep(*kept)
+                kept = None
+            if row[4] not in previous_document_ids:
+                previous_document_ids.add(row[4])
+                document_id = remaining.get(row[4])
+                if document_id is not None:
+                    if previous_stamps.get(row[4], stamps[document_id]) == stamps[document_id]:
+                        kept = [document_id, 0]
+                    else:
+                        changed += 1
+            if kept is not None:
+                corpus.write(*row)
+                kept[1] += 1
+    if kept is not None:
+        keep(*kept)
+    downloaded_document_ids.flush()
+    current = set(str(document_id) for document_id in stamps)
+    logger.info("%d unchanged, %d changed and %d removed documents in %s" %
+                (len(unchanged), changed, len(previous_document_ids - current), previous_corpus_csv))
+    return unchanged
+
+
+def write_corpus(rows, corpus_csv, max_memory=None):
+    """
+    Write the rows of a corpus to a corpus file, formatted the way CorpusFileType.output_format formats them.
+
+    Only the first row with each answer ID is kept, and the rows are sorted by document ID and then answer ID, both
+    compared as strings. The rows are de-duplicated and sorted by external merge sorts that spill to temporary files
+    next to the corpus file, so that only about max_memory bytes of rows are held in memory at once.
+
+    The file is written under a temporary name and renamed when it is complete.
+
+    :param rows: rows with the CorpusFileType columns, their values strings
+    :type rows: iterator of list of str
+    :param corpus_csv: name of the corpus file
+    :type corpus_csv: str
+    :param max_memory: approximate maximum number of bytes of rows to hold in memory, if None hold all of them
+    :type max_memory: int
+    :return: number of documents and answers in the corpus
+    :rtype: (int, int)
+    """
+
+    def first_row_for_each_answer(sorted_rows):
+        answer_id = None
+        for row in sorted_rows:
+            if row[0] != answer_id:
+                answer_id = row[0]
+                yield row
+
+    def row_size(row):
+        # Characters of the values plus the Python objects that hold them.
+        return sum(len(value) for value in row) + 400
+
+    # The two sorts may each hold a run in memory at the same time.
+    sort = functools.partial(external_sort, run_size=None, directory=os.path.dirname(os.path.abspath(corpus_csv)),
+                             max_bytes=max_memory // 2 if max_memory is not None else None, size=row_size)
+    answer_ids = itemgetter(0)
+    documents = itemgetter(4, 0)
+    unique = first_row_for_each_answer(sort(rows, key=answer_ids))
+    n = m = 0
+    with io.open(corpus_csv + ".temp", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(CorpusFileType.columns)
+        document_id = None
+        for row in sort(unique, key=documents):
+            if row[4] != document_id:
+                document_id = row[4]
+                n += 1
+            writer.writerow(row)
+            m += 1
+    os.replace(corpus_csv + ".temp", corpus_csv)
+    return n, m
 
 
 def augment_corpus_answers(corpus, qa_pairs):
@@ -176,14 +562,18 @@ class PauCheckpoint(DataFrameCheckpoint):
             self.invalid += 1
 
 
-def augment_corpus_truth(xmgr, corpus, truth, checkpoint_frequency):
+def augment_corpus_truth(xmgr, corpus, truth, checkpoint_frequency, workers=None, output_directory="."):
     """
     Find answer IDs referenced in the truth file that are missing from the corpus, download them from XMGR, then add
     them to the corpus.
 
-    Intermediary results are periodically written to an augment.temp.csv file in the current directory so that
+    Intermediary results are periodically written to an augment.temp.csv file in the output directory so that
     downloading can resume from where it left off if it fails in the middle. The augment.temp.csv file is deleted upon
-    completion of downloading.
+    completion of downloading. PAU ids that could not be downloaded because of an error are listed in an
+    augment.dead-letter.csv file in the output directory.
+
+    Several PAUs may be downloaded at once by a pool of workers. XMGR's GroundTruth API only looks up one PAU per
+    request, so the workers are the only way to download them in bulk.
 
     :param xmgr: connection to an XMGR project REST API
     :type xmgr: XmgrProject
@@ -193,6 +583,10 @@ def augment_corpus_truth(xmgr, corpus, truth, checkpoint_frequency):
     :type truth: pandas.DataFrame
     :checkpoint_frequency: how often to write intermediate results to a checkpoint file
     :type checkpoint_frequency: int
+    :param workers: number of PAUs to download concurrently, if None download them one at a time
+    :type workers: int
+    :param output_directory: directory in which to write the checkpoint and dead letter files
+    :type output_directory: str
     :return: augmented answer corpus
     :rtype: pandas.DataFrame
     """
@@ -210,8 +604,10 @@ def augment_corpus_truth(xmgr, corpus, truth, checkpoint_frequency):
     missing_pau_ids = truth[missing_truth_in_corpus(corpus, truth)][ANSWER_ID].drop_duplicates()
     l = len(missing_pau_ids)
     logger.info("%d answer IDs referenced in truth missing from corpus" % l)
-    checkpoint = PauCheckpoint("augment.temp.csv", checkpoint_frequency)
-    get_items("PAUs", missing_pau_ids, checkpoint, get_pau, checkpoint_frequency)
+    ensure_directory_exists(output_directory)
+    checkpoint = PauCheckpoint(os.path.join(output_directory, "augment.temp.csv"), checkpoint_frequency)
+    dead_letter = dead_letter_checkpoint(os.path.join(output_directory, "augment.dead-letter.csv"), ANSWER_ID)
+    get_items("PAUs", missing_pau_ids, checkpoint, get_pau, checkpoint_frequency, workers, dead_letter=dead_letter)
     new_corpus = from_csv(checkpoint.filename())
     new_corpus[DOCUMENT_ID] = os.path.basename(truth.filename)
     corpus = pandas.concat([corpus, new_corpus])
@@ -221,7 +617,13 @@ def augment_corpus_truth(xmgr, corpus, truth, checkpoint_frequency):
         logger.info("Added %d unique answers (%0.3f%%)" % (m, 100.0 * m / n))
     if checkpoint.invalid:
         logger.info("Failed to download %d PAU ids (%0.3f%%)" % (checkpoint.invalid, 100.0 * checkpoint.invalid / l))
-    os.remove(checkpoint.filename())
+    failed = dead_letters(dead_letter)
+    if failed:
+        logger.warning("Error downloading %d PAU ids (%0.3f%%), listed in %s" %
+                       (failed, 100.0 * failed / l, dead_letter.filename()))
+    else:
+        dead_letter.remove()
+    checkpoint.remove()
     return corpus
 
 
@@ -329,46 +731,101 @@ def examine_truth(corpus, truth):
 
 
 class DownloadCorpusFromXmgrClosure(object):
-    def __init__(self, xmgr, output_directory, checkpoint_frequency, max_docs):
+    def __init__(self, xmgr, output_directory, checkpoint_frequency, max_docs, journal=False, shard=None,
+                 workers=None, pau_workers=None, sync=False, max_memory=None):
         self.xmgr = xmgr
         self.output_directory = output_directory
         self.checkpoint_frequency = checkpoint_frequency
         self.max_docs = max_docs
+        self.journal = journal
+        self.shard = shard
+        self.workers = workers
+        self.pau_workers = pau_workers
+        self.sync = sync
+        self.max_memory = max_memory
 
     def __call__(self):
-        download_corpus_from_xmgr(self.xmgr, self.output_directory, self.checkpoint_frequency, self.max_docs)
+        download_corpus_from_xmgr(self.xmgr, self.output_directory, self.checkpoint_frequency, self.max_docs,
+                                  self.journal, self.shard, self.workers, self.pau_workers, self.sync, self.max_memory)
 
 
 class XmgrProject(object):
-    def __init__(self, project_url, username, password):
+    """
+    Client of an XMGR project.
+
+    Requests are made with a session whose pool of keep-alive connections is shared by all the threads using the
+    project, so that consecutive requests do not each pay for a new connection. The pool should hold at least as many
+    connections as there are threads making requests.
+
+    If a response cache is specified, responses are looked up in it before they are requested, and cached responses that
+    have outlived the cache's time to live are revalidated with the ETag and Last-Modified headers XMGR sent with them.
+    """
+
+    def __init__(self, project_url, username, password, retry_policy=None, pool_size=10, cache=None):
         self.project_url = project_url
         self.username = username
         self.password = password
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.cache = cache
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def __repr__(self):
         return "XMGR: %s" % self.project_url
 
-    def get_questions(self, pagesize=500):
+    def get_questions(self, pagesize=500, workers=None):
         questions = []
-        total = None
-        while total is None or len(questions) < total:
-            response = self.get('workbench/api/questions', params={"offset": len(questions), "pagesize": pagesize})
-            if total is None:
-                total = response["total"]
-            questions.extend(response["items"])
+        for page in self.get_question_pages(pagesize, workers):
+            questions.extend(page)
         logger.debug("%d questions" % len(questions))
         return questions
 
+    def get_question_pages(self, pagesize=500, workers=None):
+        """
+        Get all the questions in the project a page at a time.
+
+        The first page says how many questions there are, after which the rest of the pages may be downloaded at once
+        by a pool of workers. Pages are yielded in order regardless. The server may return fewer questions per page than
+        were asked for, so the rest of the pages are the size of the first one. If the pages do not add up to the total
+        number of questions an exception is raised after the last one.
+
+        :param pagesize: number of questions per page
+        :type pagesize: int
+        :param workers: number of pages to download at once, if None download them one at a time
+        :type workers: int
+        :return: pages of questions
+        :rtype: iterator of list of dict
+        """
+
+        def get_page(offset):
+            return self.get("workbench/api/questions", params={"offset": offset, "pagesize": pagesize})["items"]
+
+        response = self.get("workbench/api/questions", params={"offset": 0, "pagesize": pagesize})
+        total = response["total"]
+        n = len(response["items"])
+        yield response["items"]
+        offsets = range(n, total, n) if n else []
+        for i, (_, page) in enumerate(map_items(get_page, offsets, workers), 2):
+            logger.debug(percent_complete_message("Question page", i, len(offsets) + 1))
+            n += len(page)
+            yield page
+        if not n == total:
+            raise Exception("Got %d of %d questions from %s" % (n, total, self))
+
     def get_documents(self):
         return self.get("xmgr/corpus/document")
 
-    def get_paus_from_document(self, document_id):
+    def get_paus_from_document(self, document_id, workers=None):
         logger.debug("Get PAUs from document %s" % document_id)
         paus = []
-        pau_ids = self.get_pau_ids_in_document(document_id)
+        pau_ids = sorted(self.get_pau_ids_in_document(document_id))
         logger.debug("%d TREC IDs in document %s" % (len(pau_ids), document_id))
-        for trec_id in pau_ids:
-            paus.extend(self.get_paus(trec_id))
+        for _, trec_paus in map_items(self.get_paus, pau_ids, workers):
+            paus.extend(trec_paus)
         return paus
 
     def get_pau_ids_in_document(self, document_id):
@@ -387,12 +844,42 @@ class XmgrProject(object):
                 s = "GET %s, %s, Status %d" % (url, params, r.status_code)
             return s
 
+        def request():
+            response = self.session.get(url, params=params, headers=request_headers)
+            response.raise_for_status()
+            return response
+
         url = self.urljoin(self.project_url, path)
-        r = requests.get(url, auth=(self.username, self.password), params=params, headers=headers)
+        request_headers = dict(headers or {})
+        cached = None
+        if self.cache is not None:
+            key = requests.Request("GET", url, params=params).prepare().url
+            cached = self.cache.get(key)
+            if cached is not None:
+                body, etag, last_modified, fresh = cached
+                if fresh:
+                    logger.debug("GET %s, cached" % key)
+                    return json.loads(body.decode("utf-8"))
+                if etag is not None:
+                    request_headers["If-None-Match"] = etag
+                if last_modified is not None:
+                    request_headers["If-Modified-Since"] = last_modified
+        try:
+            r = self.retry_policy.call(host_name(url), request)
+            call_statistics.bytes += len(r.content)
+        except requests.HTTPError as e:
+            r = e.response
+            logger.debug(debug_msg())
+            raise
         logger.debug(debug_msg())
-        r.raise_for_status()
+        if r.status_code == 304 and cached is not None:
+            self.cache.revalidated(key)
+            return json.loads(cached[0].decode("utf-8"))
         try:
-            return r.json()
+            value = r.json()
+            if self.cache is not None:
+                self.cache.put(key, r.content, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+            return value
         except ValueError as e:
             # When it handles an invalid URL, XMGR returns HTTP status 200 with text on a web page describing the
             # error. This web text cannot be parsed as JSON, causing a confusing ValueError to be thrown. Catch this